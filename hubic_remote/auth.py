@@ -18,9 +18,14 @@
 """hubiC authentication module"""
 
 import datetime
+import hashlib
 import http.server
+import json
+import os
+import os.path
 import subprocess
 import sys
+import threading
 import urllib.parse
 import webbrowser
 
@@ -28,11 +33,20 @@ import dateutil.parser
 import dateutil.tz
 import rauth
 
+from . import trace
+
 REDIRECT_PORT = 18181
 REDIRECT_URI = "http://localhost:%d/" % REDIRECT_PORT
 
 DATETIME_MIN = datetime.datetime(2000, 1, 1, tzinfo=dateutil.tz.tzlocal())
 
+# The hubiC API can be replaced by a local stand-in, such as test/fake_hubic.py
+API_URL = os.getenv("GIT_ANNEX_HUBIC_API_URL", "https://api.hubic.com/").rstrip("/") + "/"
+
+# Tokens are renewed this long before they expire, so that they don't expire
+# during a transfer
+DEFAULT_REFRESH_MARGIN = 300  # seconds
+
 def now():
     """Timezone-aware version of datetime.datetime.now"""
     return datetime.datetime.now(dateutil.tz.tzlocal())
@@ -54,9 +68,9 @@ def open_new_tab(url):
 class HubicAuth(object):
     """Handle authentication using the hubiC API"""
 
-    access_token_url = "https://api.hubic.com/oauth/token"
-    authorize_url = "https://api.hubic.com/oauth/auth"
-    base_url = "https://api.hubic.com/1.0/"
+    access_token_url = API_URL + "oauth/token"
+    authorize_url = API_URL + "oauth/auth"
+    base_url = API_URL + "1.0/"
 
     # OAuth credentials -- should not be published, but it's so much easier.
     # Feel free to replace them with your own!
@@ -80,6 +94,12 @@ class HubicAuth(object):
 
         self.swift_token = self.swift_endpoint = None
         self.swift_token_expiration = DATETIME_MIN
+        self.swift_lock = threading.Lock()
+
+        # File where tokens are kept between runs, set when preparing
+        self.tokens_filename = None
+
+        self.refresh_margin = datetime.timedelta(seconds=DEFAULT_REFRESH_MARGIN)
 
 
     def initialize(self):
@@ -135,18 +155,32 @@ class HubicAuth(object):
 
 
     def prepare(self):
-        """Prepare for OAuth2 access"""
+        """Prepare for OAuth2 access. Return True on success."""
         self.remote.debug("Preparing the remote")
         self.refresh_token = self.get_refresh_token()
         if self.refresh_token is None:
             self.remote.send("PREPARE-FAILURE No credentials found")
+            return False
+
+        refresh_margin = self.remote.get_config("hubic_token_refresh_margin")
+        if refresh_margin is not None:
+            self.refresh_margin = datetime.timedelta(seconds=int(refresh_margin))
+
+        # Tokens obtained by a previous run can be used until they expire
+        git_dir = self.remote.get_git_dir()
+        if git_dir is not None:
+            self.tokens_filename = os.path.join(git_dir, "annex", "hubic",
+                                                self.remote.get_uuid() + "-tokens.json")
+            self.load_tokens()
 
         try:
-            self.refresh_swift_token()
+            if self.swift_token_expired():
+                self.refresh_swift_token()
         except Exception as exc:
             self.remote.send("PREPARE-FAILURE " + str(exc))
-            return
+            return False
         self.remote.send("PREPARE-SUCCESS")
+        return True
 
 
     def get_embed_creds(self):
@@ -182,9 +216,62 @@ class HubicAuth(object):
             self.remote.set_credentials("token", "hubic", token)
 
 
+    def refresh_token_hash(self):
+        """Identify the refresh token the other tokens were obtained with"""
+        return hashlib.sha256(self.refresh_token.encode("utf-8")).hexdigest()
+
+    def load_tokens(self):
+        """Load the tokens saved by a previous run, if they were obtained with
+        the current refresh token"""
+        try:
+            with open(self.tokens_filename) as tokens_file:
+                tokens = json.load(tokens_file)
+        except (IOError, ValueError):
+            return
+        if not isinstance(tokens, dict) \
+           or tokens.get("refresh_token_hash") != self.refresh_token_hash():
+            return
+
+        # Files from older versions, or edited by hand, may lack some values:
+        # then the tokens are refreshed as usual
+        try:
+            access_token = tokens["access_token"]
+            access_token_expiration = dateutil.parser.parse(tokens["access_token_expiration"])
+            swift_endpoint = tokens["swift_endpoint"]
+            swift_token = tokens["swift_token"]
+            swift_token_expiration = dateutil.parser.parse(tokens["swift_token_expiration"])
+        except (KeyError, TypeError, ValueError, OverflowError):
+            return
+        self.remote.debug("Using saved tokens")
+        self.access_token = access_token
+        self.access_token_expiration = access_token_expiration
+        self.swift_endpoint = swift_endpoint
+        self.swift_token = swift_token
+        self.swift_token_expiration = swift_token_expiration
+
+    def save_tokens(self):
+        """Save the tokens for the next runs, in a file only readable by the
+        user"""
+        if self.tokens_filename is None:
+            return
+        tokens = {
+            "refresh_token_hash": self.refresh_token_hash(),
+            "access_token": self.access_token,
+            "access_token_expiration": self.access_token_expiration.isoformat(),
+            "swift_endpoint": self.swift_endpoint,
+            "swift_token": self.swift_token,
+            "swift_token_expiration": self.swift_token_expiration.isoformat(),
+        }
+        os.makedirs(os.path.dirname(self.tokens_filename), exist_ok=True)
+        tmp_filename = "%s.%d" % (self.tokens_filename, os.getpid())
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as tokens_file:
+            json.dump(tokens, tokens_file)
+        os.replace(tmp_filename, self.tokens_filename)
+
     def get_session(self):
         """Get an authenticated OAuth2 session"""
-        if self.access_token_expiration <= now():
+        if self.access_token_expiration - self.refresh_margin <= now():
             self.refresh_access_token()
         return self.service.get_session(token=self.access_token)
 
@@ -196,34 +283,50 @@ class HubicAuth(object):
             "grant_type": "refresh_token"
         }
         self.remote.debug("Refreshing the OAuth access token")
-        tokens = self.service.get_raw_access_token(data=data).json()
+        with trace.span("oauth-refresh"):
+            trace.count("requests")
+            tokens = self.service.get_raw_access_token(data=data).json()
         self.access_token = tokens["access_token"]
         self.access_token_expiration = now() + datetime.timedelta(seconds=tokens["expires_in"])
         self.remote.debug("The current OAuth access token expires in %d seconds" % tokens["expires_in"])
+        self.save_tokens()
 
 
     def refresh_swift_token(self):
         """Refresh the OpenStack access token"""
         self.remote.debug("Refreshing the OpenStack access token")
         sess = self.get_session()
-        swift_creds = sess.get("account/credentials").json()
+        with trace.span("swift-credentials"):
+            trace.count("requests")
+            swift_creds = sess.get("account/credentials").json()
         self.swift_token = swift_creds['token']
         self.swift_endpoint = swift_creds['endpoint']
         self.swift_token_expiration = dateutil.parser.parse(swift_creds['expires'])
         delta = self.swift_token_expiration - now()
         self.remote.debug("The current OpenStack access token expires in %d seconds" % delta.total_seconds())
+        self.save_tokens()
 
 
     def swift_token_expired(self):
-        """Check if the current OpenStack access token has expired"""
-        return self.swift_token_expiration <= now()
+        """Check if the current OpenStack access token has expired, or is about
+        to expire"""
+        return self.swift_token_expiration - self.refresh_margin <= now()
 
 
     def get_swift_credentials(self):
         """Get a valid OpenStack endpoint and access token"""
-        if self.swift_token_expired():
-            self.refresh_swift_token()
-        return (self.swift_endpoint, self.swift_token)
+        with self.swift_lock:
+            if self.swift_token_expired():
+                self.refresh_swift_token()
+            return (self.swift_endpoint, self.swift_token)
+
+
+    def invalidate_swift_token(self, token):
+        """Forget an OpenStack access token rejected by the server: it may have
+        been revoked before its expiration date"""
+        with self.swift_lock:
+            if token == self.swift_token:
+                self.swift_token_expiration = DATETIME_MIN
 
 
 class RedirectServer(http.server.HTTPServer):
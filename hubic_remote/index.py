@@ -0,0 +1,283 @@
+# Copyright (c) 2014-2016 Thomas Jost and the Contributors
+#
+# This file is part of git-annex-remote-hubic.
+#
+# git-annex-remote-hubic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# git-annex-remote-hubic is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# git-annex-remote-hubic. If not, see <http://www.gnu.org/licenses/>.
+
+"""Index of the keys stored on hubiC, built from container listings"""
+
+import os
+import os.path
+import re
+import sqlite3
+import threading
+import time
+
+LISTING_PAGE_SIZE = 10000
+
+CHUNK_RE = re.compile(r"^chunk(\d{4,})$")
+SEGMENT_RE = re.compile(r"^segment(\d{4,})$")
+KEY_FIELD_RE = re.compile(r"^([a-zA-Z])(\d+)$")
+
+def index_filename(git_dir, uuid):
+    """Get the path of the persistent index of a remote"""
+    return os.path.join(git_dir, "annex", "hubic", uuid + "-index.sqlite")
+
+def parse_name(name, prefix):
+    """Find the key and chunk index of an object, given its name and the prefix
+    of the remote. Return None if it does not look like a chunk: segments of
+    files stored as a manifest are not recorded, the manifest stands for them."""
+    if not name.startswith(prefix):
+        return None
+    parts = name[len(prefix):].split("/")
+    if SEGMENT_RE.match(parts[-1]) is not None and len(parts) >= 2:
+        return None
+    match = CHUNK_RE.match(parts[-1])
+    if match is not None and len(parts) >= 2:
+        return parts[-2], int(match.group(1))
+    return parts[-1], 0
+
+def key_size(key):
+    """Get the size of the data stored for a key, if it can be found from the
+    key name. This is not possible for encrypted keys."""
+    fields = {}
+    for field in key.split("--", 1)[0].split("-")[1:]:
+        match = KEY_FIELD_RE.match(field)
+        if match is not None:
+            fields[match.group(1)] = int(match.group(2))
+    if "s" not in fields:
+        return None
+    if "S" in fields and "C" in fields:
+        # Key of a chunk created by git-annex itself
+        return max(0, min(fields["S"], fields["s"] - (fields["C"] - 1) * fields["S"]))
+    return fields["s"]
+
+class ListingIndex(object):
+    """In-memory index of the keys stored under a path of a container: for each
+    key, the path of its first chunk and the size and ETag of its chunks. The
+    directory markers found there are also recorded.
+
+    It is built from a full listing of the path, and is considered valid for
+    ttl seconds. Changes made by this process are recorded in the index."""
+
+    # Keys missing from the index are not stored
+    authoritative = True
+
+    def __init__(self, container, path, ttl):
+        self.container = container
+        self.prefix = path.rstrip("/") + "/" if path else ""
+        self.ttl = ttl
+        self.keys = {}
+        self.directories = set()
+        self.expiration = 0
+
+    def expired(self):
+        """Check if the index needs to be refreshed"""
+        return self.expiration <= time.time()
+
+    def refresh(self, conn):
+        """List all the objects of the remote, one page at a time"""
+        self.keys = {}
+        self.directories = set()
+        marker = ""
+        while True:
+            _, objects = conn.get_container(self.container, prefix=self.prefix, marker=marker,
+                                            limit=LISTING_PAGE_SIZE)
+            if len(objects) == 0:
+                break
+            for obj in objects:
+                if obj.get("content_type") == "application/directory":
+                    self.add_directory(obj["name"])
+                else:
+                    self.add(obj["name"], obj["bytes"], obj["hash"])
+            if len(objects) < LISTING_PAGE_SIZE:
+                break
+            marker = objects[-1]["name"]
+        self.expiration = time.time() + self.ttl
+
+    def add(self, name, size, etag):
+        """Record an object"""
+        parsed = parse_name(name, self.prefix)
+        if parsed is None:
+            return
+        key, idx = parsed
+        entry = self.keys.setdefault(key, {"path": None, "chunks": {}})
+        entry["chunks"][idx] = (size, etag)
+        if idx == 0:
+            entry["path"] = name
+
+    def forget(self, key):
+        """Forget everything about a key"""
+        self.keys.pop(key, None)
+
+    def get(self, key):
+        """Get the path and chunks of a key, or None if it is not stored"""
+        entry = self.keys.get(key)
+        if entry is None or entry["path"] is None:
+            return None
+        return entry
+
+    def add_directory(self, name):
+        """Record a directory marker"""
+        self.directories.add(name)
+
+    def forget_directory(self, name):
+        """Forget a directory marker"""
+        self.directories.discard(name)
+
+    def has_directory(self, name):
+        """Check if a directory marker is known to exist"""
+        return name in self.directories
+
+class PersistentIndex(object):
+    """SQLite index of the keys stored under a path of a container, saved in the
+    git-annex directory of the repository: for each key, the path, size and ETag
+    of its chunks. The directory markers found there are also recorded.
+
+    Changes made by the remote are recorded in the index, but it is only
+    refreshed on demand, by listing the whole path. This listing is incremental:
+    each page is saved with the position in the listing, so an interrupted
+    refresh can be resumed."""
+
+    # Keys may have been stored or removed from another repository since the
+    # last refresh: missing keys are checked on the server, and keys found in
+    # the index are confirmed there
+    authoritative = False
+
+    def __init__(self, filename, container, path):
+        self.container = container
+        self.prefix = path.rstrip("/") + "/" if path else ""
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS objects ("
+                            "name TEXT PRIMARY KEY, key TEXT NOT NULL, chunk INTEGER NOT NULL, "
+                            "bytes INTEGER NOT NULL, etag TEXT NOT NULL, "
+                            "generation INTEGER NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS objects_key ON objects (key)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS directories ("
+                            "name TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)")
+
+            # Start from scratch if the remote now points somewhere else
+            if self._get_state("location") != container + "/" + self.prefix:
+                self.db.execute("DELETE FROM objects")
+                self.db.execute("DELETE FROM directories")
+                self.db.execute("DELETE FROM state")
+                self._set_state("location", container + "/" + self.prefix)
+                self._set_state("generation", 0)
+
+    def _get_state(self, name):
+        row = self.db.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_state(self, name, value):
+        self.db.execute("INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)", (name, value))
+
+    def _add(self, name, size, etag, generation):
+        parsed = parse_name(name, self.prefix)
+        if parsed is not None:
+            key, idx = parsed
+            self.db.execute("INSERT OR REPLACE INTO objects "
+                            "(name, key, chunk, bytes, etag, generation) "
+                            "VALUES (?, ?, ?, ?, ?, ?)", (name, key, idx, size, etag, generation))
+
+    def _add_directory(self, name, generation):
+        self.db.execute("INSERT OR REPLACE INTO directories (name, generation) VALUES (?, ?)",
+                        (name, generation))
+
+    def expired(self):
+        """The index is only refreshed on demand"""
+        return False
+
+    def refresh(self, conn, progress=None):
+        """List all the objects of the remote, one page at a time, resuming an
+        interrupted refresh if any. If given, progress is called with the number
+        of objects listed after each page."""
+        with self.lock, self.db:
+            generation = int(self._get_state("generation"))
+            marker = self._get_state("marker")
+            if marker is None:
+                # New refresh: objects not seen during it will be removed
+                generation += 1
+                marker = ""
+                self._set_state("generation", generation)
+                self._set_state("marker", marker)
+
+        nb_objects = 0
+        while True:
+            _, objects = conn.get_container(self.container, prefix=self.prefix, marker=marker,
+                                            limit=LISTING_PAGE_SIZE)
+            with self.lock, self.db:
+                for obj in objects:
+                    if obj.get("content_type") == "application/directory":
+                        self._add_directory(obj["name"], generation)
+                    else:
+                        self._add(obj["name"], obj["bytes"], obj["hash"], generation)
+                if len(objects) > 0:
+                    marker = objects[-1]["name"]
+                    self._set_state("marker", marker)
+            nb_objects += len(objects)
+            if progress is not None:
+                progress(nb_objects)
+            if len(objects) < LISTING_PAGE_SIZE:
+                break
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM objects WHERE generation < ?", (generation,))
+            self.db.execute("DELETE FROM directories WHERE generation < ?", (generation,))
+            self.db.execute("DELETE FROM state WHERE name = 'marker'")
+            self._set_state("refreshed", time.time())
+
+    def add(self, name, size, etag):
+        """Record an object"""
+        with self.lock, self.db:
+            self._add(name, size, etag, int(self._get_state("generation")))
+
+    def forget(self, key):
+        """Forget everything about a key"""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM objects WHERE key = ?", (key,))
+
+    def get(self, key):
+        """Get the path and chunks of a key, or None if it is not stored"""
+        with self.lock:
+            rows = self.db.execute("SELECT name, chunk, bytes, etag FROM objects WHERE key = ?",
+                                   (key,)).fetchall()
+        entry = {"path": None, "chunks": {}}
+        for name, idx, size, etag in rows:
+            entry["chunks"][idx] = (size, etag)
+            if idx == 0:
+                entry["path"] = name
+        if entry["path"] is None:
+            return None
+        return entry
+
+    def add_directory(self, name):
+        """Record a directory marker"""
+        with self.lock, self.db:
+            self._add_directory(name, int(self._get_state("generation")))
+
+    def forget_directory(self, name):
+        """Forget a directory marker"""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM directories WHERE name = ?", (name,))
+
+    def has_directory(self, name):
+        """Check if a directory marker is known to exist"""
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM directories WHERE name = ?", (name,)).fetchone()
+        return row is not None
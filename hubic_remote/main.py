@@ -17,9 +17,16 @@
 
 """git-annex special remote for hubiC"""
 
+import sys
+
 from . import remote
+from . import resync
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "resync-index":
+        resync.main(sys.argv[2:])
+        return
+
     rem = remote.Remote()
     rem.run()
 
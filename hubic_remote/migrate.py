@@ -18,13 +18,26 @@
 """Migrate hubiC data out of the default container"""
 
 import argparse
+import collections
 from concurrent import futures
+import datetime
+import functools
+import json
+import os
 import os.path
+import queue
+import sqlite3
 import sys
-
-import swiftclient.client
+import tempfile
+import threading
+import time
 
 from . import auth
+from . import index
+from . import pool
+
+DEFAULT_JOBS = 10
+PROGRESS_INTERVAL = 10  # seconds
 
 
 class PseudoRemote(object):
@@ -41,28 +54,261 @@ class PseudoRemote(object):
         return None
     def get_credentials(self, *args):
         return None, None
+    def get_git_dir(self):
+        return None
+    def get_uuid(self):
+        return None
 
     def send(self, *args): pass
     def set_config(self, *args): pass
     def set_credentials(self, *args): pass
 
 
-def migrate(args, conn, target_files, idx, name, etag):
-    """Move one file to another container"""
+def list_pages(conn_pool, container, prefix, marker=""):
+    """List the objects of a container, one page at a time, starting after
+    marker"""
+    while True:
+        with conn_pool.connection() as conn:
+            _, objects = conn.get_container(container, prefix=prefix, marker=marker,
+                                            limit=index.LISTING_PAGE_SIZE)
+        if len(objects) > 0:
+            yield objects
+        if len(objects) < index.LISTING_PAGE_SIZE:
+            return
+        marker = objects[-1]["name"]
+
+
+def prefetch(iterable, size=2):
+    """Iterate over iterable in a background thread, staying up to size items
+    ahead of the consumer"""
+    items = queue.Queue(size)
+
+    def _produce():
+        try:
+            for item in iterable:
+                items.put((True, item))
+            items.put((False, None))
+        except Exception as exc:
+            items.put((False, exc))
+
+    threading.Thread(target=_produce, daemon=True).start()
+    while True:
+        has_item, item = items.get()
+        if not has_item:
+            if item is not None:
+                raise item
+            return
+        yield item
+
+
+def is_file(obj):
+    """Check if a listed object is a file, and not a directory marker"""
+    return obj.get("content_type") != "application/directory"
+
+
+def target_name(args, name):
+    """Get the name of an object in the target container. The remote doesn't
+    use dirhash directories outside of the default container, so only the key
+    is kept, and the chunk or segment name if any."""
+    parts = name.split("/")
+    if len(parts) >= 2 and (index.CHUNK_RE.match(parts[-1]) or index.SEGMENT_RE.match(parts[-1])):
+        return os.path.join(args.target_path, *parts[-2:])
+    return os.path.join(args.target_path, parts[-1])
+
+
+class TargetListing(object):
+    """Listing of the files already in the target directory, saved to a
+    temporary SQLite database where they are kept sorted by name, so that
+    files can be looked up without keeping the whole listing in memory"""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE targets (name TEXT PRIMARY KEY, hash TEXT NOT NULL, "
+                        "matched INTEGER NOT NULL DEFAULT 0)")
+
+    def close(self):
+        """Close the database"""
+        self.db.close()
+
+    def add_page(self, objects):
+        """Save a page of the target listing"""
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO targets (name, hash) VALUES (?, ?)",
+                                [(obj["name"], obj["hash"]) for obj in objects if is_file(obj)])
+
+    def match(self, entries):
+        """Look up source entries, sorted by target name, and return them as
+        (source entry, target ETag) pairs, where the ETag is None if there is no
+        such file in the target directory"""
+        matches = []
+        with self.db:
+            for entry in entries:
+                row = self.db.execute("SELECT hash FROM targets WHERE name = ?",
+                                      (entry[0],)).fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE targets SET matched = 1 WHERE name = ?", (entry[0],))
+                matches.append((entry, None if row is None else row[0]))
+        return matches
+
+    def count_unmatched(self):
+        """Count the target files that no source file was matched with"""
+        return self.db.execute("SELECT COUNT(*) FROM targets WHERE matched = 0").fetchone()[0]
+
+
+class Checkpoint(object):
+    """Source name up to which all files were processed, saved to a file after
+    each page of the listing so that an interrupted migration can be resumed
+    from there"""
+
+    def __init__(self, filename, args):
+        self.filename = filename
+        self.settings = {
+            "source_path": args.source_path,
+            "target_container": args.target_container,
+            "target_path": args.target_path,
+            "move": args.move,
+        }
+        self.marker = ""
+        self.nb_objects = self.nb_bytes = 0
+        self.failed = False
+        self._lock = threading.Lock()
+        # Pages being processed: last name -> [pending files, files, bytes]
+        self._pages = collections.OrderedDict()
+
+        if filename is None or not os.path.exists(filename):
+            return
+        with open(filename) as checkpoint:
+            data = json.load(checkpoint)
+        if data["settings"] != self.settings:
+            raise ValueError("Checkpoint %s was saved by another migration: %s"
+                             % (filename, data["settings"]))
+        self.marker = data["marker"]
+        self.nb_objects = data["objects"]
+        self.nb_bytes = data["bytes"]
+
+    def save(self):
+        """Save the checkpoint to its file, if any"""
+        if self.filename is None:
+            return
+        data = {
+            "settings": self.settings,
+            "marker": self.marker,
+            "objects": self.nb_objects,
+            "bytes": self.nb_bytes,
+        }
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as checkpoint:
+            json.dump(data, checkpoint)
+        os.replace(tmp_filename, self.filename)
+
+    def remove(self):
+        """Remove the checkpoint file, once the migration is complete"""
+        if self.filename is not None and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def add_page(self, page, entries):
+        """Start processing the files of a page of the listing, ending with
+        name page"""
+        with self._lock:
+            self._pages[page] = [len(entries), len(entries), sum(entry[3] for entry in entries)]
+            self._advance()
+
+    def file_done(self, page, success):
+        """Record that a file of a page was processed"""
+        with self._lock:
+            self._pages[page][0] -= 1
+            if not success:
+                # Files after this one will be processed again next time
+                self.failed = True
+            self._advance()
+
+    def _advance(self):
+        saved = False
+        while not self.failed and self._pages:
+            page, (pending, nb_objects, nb_bytes) = next(iter(self._pages.items()))
+            if pending > 0:
+                break
+            del self._pages[page]
+            self.marker = page
+            self.nb_objects += nb_objects
+            self.nb_bytes += nb_bytes
+            saved = True
+        if saved:
+            self.save()
+
+
+class MigrationProgress(object):
+    """Counters of a migration, reported every PROGRESS_INTERVAL seconds with
+    the rate and the estimated time left"""
+
+    def __init__(self, nb_objects=0, nb_bytes=0):
+        self.total = None
+        self.start_objects = self.nb_objects = nb_objects
+        self.start_bytes = self.nb_bytes = nb_bytes
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._start_time = self._last_report = time.monotonic()
+        self._reported = None
+
+    def file_done(self, entry, results):
+        """Record a processed file, and what was done with it"""
+        with self._lock:
+            self.nb_objects += 1
+            self.nb_bytes += entry[3]
+            self.counts.update(results)
+            if time.monotonic() - self._last_report >= PROGRESS_INTERVAL:
+                self.report()
+
+    def count(self, result, nb=1):
+        """Count something that is not a processed file"""
+        with self._lock:
+            self.counts[result] += nb
+
+    def report(self):
+        """Print the current state of the migration, unless it was just printed"""
+        if self._reported == (self.nb_objects, self.total):
+            return
+        self._reported = (self.nb_objects, self.total)
+        self._last_report = time.monotonic()
+        elapsed = max(self._last_report - self._start_time, 1e-3)
+        rate = (self.nb_objects - self.start_objects) / elapsed
+        byte_rate = (self.nb_bytes - self.start_bytes) / elapsed
+        msg = "%d/%s files (%s), %.1f files/s, %.1f MB/s" % (
+            self.nb_objects, "?" if self.total is None else self.total,
+            ", ".join("%d %s" % (nb, result) for result, nb in sorted(self.counts.items())),
+            rate, byte_rate / 2**20)
+        if self.total is not None and rate > 0:
+            eta = datetime.timedelta(seconds=int(max(0, self.total - self.nb_objects) / rate))
+            msg += ", ETA %s" % eta
+        print(msg, flush=True)
+
+
+def migrate(args, conn_pool, entry, copy):
+    """Copy one file to the target container if needed, and delete it from the
+    source when moving data. Return what was done."""
+    target_path, name, _, _ = entry
     source_path = "/" + os.path.join("default", name)
-    target_path = os.path.join(args.target_path, os.path.basename(name))
+    results = []
 
-    # First check for the target
-    if target_path not in target_files or target_files[target_path] != etag:
-        nice_target_path = "/" + args.target_container + "/" + target_path
-        print(idx, source_path, "-->", nice_target_path)
-        conn.put_object(args.target_container, target_path, contents=None,
-                        headers={"X-Copy-From": source_path,
-                                 "Content-Length": 0})
+    with conn_pool.connection() as conn:
+        if copy:
+            if args.verbose:
+                print(source_path, "-->", "/" + args.target_container + "/" + target_path)
+            conn.put_object(args.target_container, target_path, contents=None,
+                            headers={"X-Copy-From": source_path,
+                                     "Content-Length": 0})
+            results.append("copied")
+        else:
+            results.append("skipped")
 
-    if args.move:
-        print(idx, "deleting", source_path)
-        conn.delete_object("default", name)
+        if args.move:
+            if args.verbose:
+                print("deleting", source_path)
+            conn.delete_object("default", name)
+            results.append("deleted")
+    return results
 
 
 def main():
@@ -78,7 +324,20 @@ def main():
                         help="move data instead of copying them")
     parser.add_argument("--token", type=str,
                         help="OAuth2 refresh token used to log into the hubiC account")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help="number of files copied at the same time (default: %d)" % DEFAULT_JOBS)
+    parser.add_argument("--checkpoint", type=str,
+                        help="file where progress is saved, to resume an interrupted migration")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print every file copied or deleted")
     args = parser.parse_args()
+    args.jobs = max(1, args.jobs)
+
+    try:
+        checkpoint = Checkpoint(args.checkpoint, args)
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
 
     # Authenticate
     remote = PseudoRemote()
@@ -87,42 +346,82 @@ def main():
     hubic_auth.initialize()
     print("OAuth2 credentials: token=%s" % hubic_auth.refresh_token)
 
-    # Init Swift connection
-    endpoint, token = hubic_auth.get_swift_credentials()
-    options = {
-        "auth_token": token,
-        "object_storage_url": endpoint,
-    }
-    print("Swift credentials: token=%s, endpoint=%s" % (token, endpoint))
-    conn = swiftclient.client.Connection(os_options=options, auth_version=2)
+    # Init Swift connections: each thread uses its own
+    def _print_credentials(creds):
+        print("Swift credentials: token=%s, endpoint=%s" % (creds[1], creds[0]))
+    conn_pool = pool.ConnectionPool(hubic_auth.get_swift_credentials, max_size=args.jobs + 2,
+                                    on_renew=_print_credentials,
+                                    invalidate=hubic_auth.invalidate_swift_token)
 
-    # List objects in the source directory
-    _, objects = conn.get_container("default", prefix=args.source_path,
-                                    full_listing=True)
+    # Create the target container
+    with conn_pool.connection() as conn:
+        conn.put_container(args.target_container)
 
-    # Remove directories
-    files = [(obj["name"], obj["hash"]) for obj in objects
-             if obj["content_type"] != "application/directory"]
-    print("Processing %d files..." % len(files))
+    progress = MigrationProgress(checkpoint.nb_objects, checkpoint.nb_bytes)
 
-    # Create the target container
-    conn.put_container(args.target_container)
-
-    # List objects in the target directory
-    _, objects = conn.get_container(args.target_container, prefix=args.target_path,
-                                    full_listing=True)
-    target_files = {obj["name"]: obj["hash"] for obj in objects
-                    if obj["content_type"] != "application/directory"}
-
-    # Start copying files
-    with futures.ThreadPoolExecutor(max_workers=10) as executor:
-        tasks = {executor.submit(migrate, args, conn, target_files, idx+1, name, etag): idx+1
-                 for idx, (name, etag) in enumerate(files)}
-
-        for future in futures.as_completed(tasks):
-            idx = tasks[future]
-            if future.exception() is not None:
-                print('%d generated an exception: %s' % (idx, future.exception()))
+    def _done(page, entry, future):
+        slots.release()
+        exc = future.exception()
+        if exc is not None:
+            print("%s generated an exception: %s" % (entry[1], exc), flush=True)
+        progress.file_done(entry, ["failed"] if exc is not None else future.result())
+        checkpoint.file_done(page, exc is None)
+
+    with tempfile.TemporaryDirectory(prefix="hubic-migrate-") as tmp_dir:
+        # Files don't have the same names in the target directory, so the source
+        # listing can't be compared with the target listing as they come.
+        # Instead, the target listing is saved first, and the files of each page
+        # of the source listing are looked up there: copies start with the first
+        # page, and memory use doesn't depend on the number of files.
+        print("Listing target files...", flush=True)
+        targets = TargetListing(os.path.join(tmp_dir, "targets.sqlite"))
+        for objects in prefetch(list_pages(conn_pool, args.target_container, args.target_path)):
+            targets.add_page(objects)
+
+        resumed = bool(checkpoint.marker)
+        if resumed:
+            print("Resuming after %s (%d files already processed)"
+                  % (checkpoint.marker, checkpoint.nb_objects))
+        print("Processing source files...", flush=True)
+
+        # Copy files with a bounded number of pending copies, so that memory
+        # use doesn't depend on the number of files
+        slots = threading.Semaphore(2 * args.jobs)
+        nb_files = checkpoint.nb_objects
+        with futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            for objects in prefetch(list_pages(conn_pool, "default", args.source_path,
+                                               checkpoint.marker)):
+                page = objects[-1]["name"]
+                # Look files up in the order of the target listing
+                entries = sorted((target_name(args, obj["name"]), obj["name"],
+                                  obj["hash"], obj["bytes"])
+                                 for obj in objects if is_file(obj))
+                batch = targets.match(entries)
+                checkpoint.add_page(page, entries)
+                nb_files += len(entries)
+                for entry, etag in batch:
+                    copy = etag != entry[2]
+                    if not copy and not args.move:
+                        progress.file_done(entry, ["skipped"])
+                        checkpoint.file_done(page, True)
+                        continue
+                    slots.acquire()
+                    future = executor.submit(migrate, args, conn_pool, entry, copy)
+                    future.add_done_callback(functools.partial(_done, page, entry))
+            # The total is only known once the source is listed
+            progress.total = nb_files
+
+        # Files processed before a checkpoint were not looked up this time
+        nb_unmatched = targets.count_unmatched()
+        if not resumed and nb_unmatched > 0:
+            progress.count("only in target", nb_unmatched)
+        targets.close()
+
+    progress.report()
+    if checkpoint.failed:
+        print("Some files could not be processed: run the same command again to retry them")
+        sys.exit(1)
+    checkpoint.remove()
 
 
 if __name__ == "__main__":
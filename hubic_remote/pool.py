@@ -0,0 +1,268 @@
+# Copyright (c) 2014-2016 Thomas Jost and the Contributors
+#
+# This file is part of git-annex-remote-hubic.
+#
+# git-annex-remote-hubic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# git-annex-remote-hubic is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# git-annex-remote-hubic. If not, see <http://www.gnu.org/licenses/>.
+
+"""Pool of Swift connections shared between threads"""
+
+import contextlib
+import http.client
+import json
+import os
+import selectors
+import socket
+import threading
+import urllib.parse
+import urllib.request
+import weakref
+
+import swiftclient.client
+from swiftclient.exceptions import ClientException
+
+from . import trace
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_TIMEOUT = 60
+SENDFILE_MAX_SIZE = 2**23  # 8 MB, sent at most by each sendfile call
+
+def sendfile(sock, fd, offset, size, progress=None):
+    """Send size bytes of a file descriptor to a socket, starting at offset,
+    without copying them to userspace. If given, progress is called with the
+    number of bytes sent after each sendfile call."""
+    sent = 0
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_WRITE)
+        while sent < size:
+            if not selector.select(sock.gettimeout()):
+                raise socket.timeout("timed out")
+            try:
+                length = os.sendfile(sock.fileno(), fd, offset + sent,
+                                     min(size - sent, SENDFILE_MAX_SIZE))
+            except BlockingIOError:
+                continue
+            if length == 0:
+                raise ValueError("Unexpected end of file after %d bytes" % (offset + sent))
+            sent += length
+            if progress is not None:
+                progress(sent)
+
+def put_object_sendfile(url, token, container, name, fd, offset, size, progress=None,
+                        headers=None, conn=None, http_conn=None, service_token=None):
+    """Upload size bytes of a file descriptor, starting at offset, using
+    sendfile. This works like swiftclient's put_object, but only with plain
+    HTTP and without proxies, through conn, an http.client connection to the
+    host of url kept open between requests. The http_conn given by swiftclient
+    is not used, as requests doesn't give access to its sockets. Return the
+    ETag of the object."""
+    parsed = urllib.parse.urlsplit(url)
+    path = "%s/%s/%s" % (parsed.path.rstrip("/"), urllib.parse.quote(container),
+                         urllib.parse.quote(name))
+    request_headers = {"X-Auth-Token": token, "Content-Length": str(size)}
+    if service_token:
+        request_headers["X-Service-Token"] = service_token
+    if headers is not None:
+        request_headers.update(headers)
+
+    try:
+        conn.putrequest("PUT", path, skip_accept_encoding=True)
+        for header, value in request_headers.items():
+            conn.putheader(header, value)
+        conn.endheaders()
+        sendfile(conn.sock, fd, offset, size, progress)
+        resp = conn.getresponse()
+        body = resp.read()
+    except BaseException:
+        # Open a new connection for the next attempt
+        conn.close()
+        raise
+
+    if resp.status < 200 or resp.status >= 300:
+        raise ClientException("Object PUT failed", http_scheme=parsed.scheme,
+                              http_host=parsed.hostname, http_port=parsed.port,
+                              http_path=path, http_status=resp.status,
+                              http_reason=resp.reason, http_response_content=body)
+    return resp.getheader("etag", "").strip('"')
+
+def delete_manifest(url, token, container, name, http_conn=None, service_token=None):
+    """Delete a Static Large Object manifest along with its segments. This works
+    like swiftclient's delete_object with ?multipart-manifest=delete, but also
+    returns the JSON body of the response: Swift answers with a 200 status even
+    when some segments, or the manifest itself, couldn't be deleted, and
+    reports it there."""
+    parsed, conn = http_conn
+    path = "%s/%s/%s?multipart-manifest=delete" % (
+        parsed.path.rstrip("/"), urllib.parse.quote(container), urllib.parse.quote(name))
+    headers = {"X-Auth-Token": token, "Accept": "application/json"}
+    if service_token:
+        headers["X-Service-Token"] = service_token
+    conn.request("DELETE", path, "", headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    if resp.status < 200 or resp.status >= 300:
+        raise ClientException.from_response(resp, "Object DELETE failed", body)
+    return json.loads(body.decode("utf-8")) if body else {}
+
+class PooledConnection(swiftclient.client.Connection):
+    """Swift connection that gets new credentials from its pool when the server
+    rejects its token, and then tries again"""
+
+    def __init__(self, pool, *args, **kwds):
+        self.pool = pool
+        self.sendfile_conn = None
+        super().__init__(*args, **kwds)
+
+    def close(self):
+        super().close()
+        if self.sendfile_conn is not None:
+            self.sendfile_conn.close()
+            self.sendfile_conn = None
+
+    def _retry(self, reset_func, func, *args, **kwargs):
+        with trace.span("swift-" + func.__name__.replace("_", "-")):
+            token = self.token
+            retry_kwargs = dict(kwargs)
+            try:
+                return self._counted_retry(reset_func, func, *args, **kwargs)
+            except ClientException as exc:
+                if exc.http_status != 401:
+                    raise exc
+                self.url, self.token = self.pool.renew(token)
+                if self.token == token:
+                    raise exc
+                if reset_func is not None:
+                    reset_func(func, *args, **retry_kwargs)
+                return self._counted_retry(reset_func, func, *args, **retry_kwargs)
+
+    def can_sendfile(self):
+        """Check if objects can be uploaded with put_object_sendfile"""
+        if not hasattr(os, "sendfile") or self.url is None:
+            return False
+        parsed = urllib.parse.urlsplit(self.url)
+        if parsed.scheme != "http":
+            return False
+        return "http" not in urllib.request.getproxies() \
+            or bool(urllib.request.proxy_bypass(parsed.hostname))
+
+    def put_object_sendfile(self, container, name, fd, offset, size, progress=None,
+                            headers=None):
+        """Upload part of a file with sendfile (see put_object_sendfile)"""
+        parsed = urllib.parse.urlsplit(self.url)
+        if self.sendfile_conn is None \
+           or (self.sendfile_conn.host, self.sendfile_conn.port) != (parsed.hostname,
+                                                                     parsed.port or 80):
+            if self.sendfile_conn is not None:
+                self.sendfile_conn.close()
+            self.sendfile_conn = http.client.HTTPConnection(parsed.hostname, parsed.port,
+                                                            timeout=self.timeout)
+        return self._retry(None, put_object_sendfile, container, name, fd, offset, size,
+                           progress=progress, headers=headers, conn=self.sendfile_conn)
+
+    def delete_manifest(self, container, name):
+        """Delete a manifest and its segments (see delete_manifest)"""
+        return self._retry(None, delete_manifest, container, name)
+
+    def _counted_retry(self, *args, **kwargs):
+        """Run a request, counting the attempts swiftclient makes"""
+        try:
+            return super()._retry(*args, **kwargs)
+        finally:
+            trace.count("requests", self.attempts)
+
+class ConnectionPool(object):
+    """Pool of Swift connections
+
+    A swiftclient connection can't be used by several threads at once, so each
+    thread borrows one with get() and gives it back with put(), or uses the
+    connection() context manager. Connections given back are kept open for
+    later use (up to max_size of them), so that HTTP connections are reused.
+
+    Credentials come from get_credentials, which must return an (endpoint,
+    token) tuple. When they change, all the connections of the pool, including
+    borrowed ones, are updated. If given, on_renew is then called with the new
+    credentials. When the server rejects a token, invalidate (if given) is
+    called with it before getting credentials again."""
+
+    def __init__(self, get_credentials, max_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 on_renew=None, invalidate=None):
+        self._get_credentials = get_credentials
+        self._invalidate = invalidate
+        self._max_size = max_size
+        self._timeout = timeout
+        self._on_renew = on_renew
+        self._lock = threading.Lock()
+        self._idle = []
+        self._all = weakref.WeakSet()
+        self._creds = None
+
+    def refresh(self):
+        """Make sure all connections use valid credentials, getting new ones if
+        needed"""
+        creds = self._get_credentials()
+        with self._lock:
+            if creds == self._creds:
+                return
+            self._creds = creds
+            for conn in self._all:
+                conn.url, conn.token = creds
+        if self._on_renew is not None:
+            self._on_renew(creds)
+
+    def renew(self, token):
+        """Get new credentials after the server rejected token"""
+        if self._invalidate is not None:
+            self._invalidate(token)
+        self.refresh()
+        with self._lock:
+            return self._creds
+
+    def get(self):
+        """Borrow a connection"""
+        self.refresh()
+        with self._lock:
+            if len(self._idle) > 0:
+                return self._idle.pop()
+            endpoint, token = self._creds
+            options = {
+                "auth_token": token,
+                "object_storage_url": endpoint,
+            }
+            conn = PooledConnection(self, os_options=options, auth_version=2,
+                                    timeout=self._timeout)
+            self._all.add(conn)
+            return conn
+
+    def put(self, conn):
+        """Give back a borrowed connection"""
+        with self._lock:
+            if len(self._idle) < self._max_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager borrowing a connection"""
+        conn = self.get()
+        try:
+            yield conn
+        finally:
+            self.put(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
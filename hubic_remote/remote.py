@@ -18,13 +18,40 @@
 """git-annex special remote for hubiC"""
 
 import errno
+import hashlib
+import os
+import queue
+import struct
 import sys
+import threading
 
 from . import auth
 from . import swift
+from . import trace
 
 REMOTE_COST = 175  # Semi-expensive remote as per Config/Cost.hs
 
+DIRHASH_CHARS = "0123456789zqjxkmvwgpfZQJXKMVWGPF"
+
+def non_chunk_key(key):
+    """Remove the chunk size and number fields (-S and -C) from a key, as done
+    by nonChunkKey in Types/Key.hs"""
+    fields, sep, name = key.partition("--")
+    fields = fields.split("-")
+    fields = fields[:1] + [field for field in fields[1:]
+                           if not (field[:1] in ("S", "C") and field[1:].isdigit())]
+    return "-".join(fields) + sep + name
+
+def hash_dir_mixed(key):
+    """Compute the two level hash git-annex associates with a key, as described
+    in Annex/DirHashes.hs (hashDirMixed). Chunks of a key are hashed like the
+    key itself."""
+    key = non_chunk_key(key)
+    word = struct.unpack("<I", hashlib.md5(key.encode("utf-8")).digest()[:4])[0]
+    chars = [DIRHASH_CHARS[(word >> (6 * i)) & 31] for i in range(4)]
+    return "%s%s/%s%s/" % (chars[1], chars[0], chars[3], chars[2])
+
+
 class Remote(object):
     """git-annex special remote protocol implementation"""
 
@@ -37,8 +64,23 @@ class Remote(object):
 
         self.fin = fin
         self.fout = fout
+        self.fout_lock = threading.Lock()
 
         self.auth = None
+        self.prepared = False
+        self.prepare_lock = threading.Lock()
+
+        # With the ASYNC extension, each job has its own thread, and messages
+        # of a job are prefixed with its number. The current job is stored in
+        # self.local.
+        self.jobs = {}
+        self.local = threading.local()
+
+        # Configuration values and things that don't change while running
+        self.config = {}
+        self.uuid = None
+        self.git_dir = None
+        self.local_dirhash = None
 
     def send(self, msg):
         """Send a message to git-annex"""
@@ -49,9 +91,15 @@ class Remote(object):
         if self.fout.closed:
             _closed()
 
+        job = getattr(self.local, "job", None)
+        if job is not None:
+            msg = "J %s %s" % (job.number, msg)
+
+        trace.count("messages")
         try:
-            self.fout.write("%s\n" % msg)
-            self.fout.flush()
+            with self.fout_lock:
+                self.fout.write("%s\n" % msg)
+                self.fout.flush()
         except IOError as exc:
             if exc.errno == errno.EPIPE:
                 _closed()
@@ -60,8 +108,20 @@ class Remote(object):
 
     def read(self):
         """Read a message from git-annex"""
+        job = getattr(self.local, "job", None)
+        if job is not None:
+            return job.queue.get()
         return self.fin.readline().strip()
 
+    def in_job(self, func):
+        """Wrap func so that it runs in the current job, even when called from
+        another thread"""
+        job = getattr(self.local, "job", None)
+        def _run(*args, **kwds):
+            self.local.job = job
+            return func(*args, **kwds)
+        return trace.wrap(_run)
+
     def debug(self, msg):
         """Send a debug message to git-annex"""
         self.send("DEBUG " + msg)
@@ -96,36 +156,88 @@ class Remote(object):
         self.auth = auth.HubicAuth(self)
 
         while True:
-            line = self.read().split(None, 1)
+            line = self.read()
 
             # Empty line: exit
             if len(line) == 0:
                 return
 
-            command = line[0]
-
-            # Boring commands -- reply immediately
-            if command == "GETCOST":
-                self.send("COST %d" % REMOTE_COST)
-            elif command == "GETAVAILABILITY":
-                self.send("AVAILABILITY GLOBAL")
-
-            # Init commands -- from auth.py
-            elif command == "INITREMOTE":
-                self.auth.initialize()
-
-            elif command == "PREPARE":
-                self.auth.prepare()
+            # Message for a job: start a thread for it if it is a new one
+            if line.startswith("J "):
+                _, number, msg = line.split(None, 2)
+                job = self.jobs.get(number)
+                if job is None:
+                    job = self.jobs[number] = Job(number)
+                    thread = threading.Thread(target=self._run_job, args=(job,), daemon=True)
+                    thread.start()
+                job.queue.put(msg)
+            else:
+                self.handle(line)
 
-            # File transfer commands -- from swift.py
-            elif command == "TRANSFER":
-                subcommand, key, filename = line[1].split(None, 2)
-                try:
-                    conn = swift.SwiftConnection(self)
-                except Exception as exc:
-                    self.send("TRANSFER-%s FAILURE %s %s" % (subcommand, key, str(exc)))
-                    continue
+    def _run_job(self, job):
+        """Handle the requests of a job, in its own thread"""
+        self.local.job = job
+        while True:
+            line = self.read()
+            try:
+                self.handle(line)
+            except SystemExit as exc:
+                # fatal() only ends the current thread: end the whole process
+                # instead, or git-annex would wait forever for this job
+                os._exit(exc.code if isinstance(exc.code, int) else 1)
+            except Exception as exc:
+                self.error(str(exc))
+
+    def handle(self, line):
+        """Handle a request from git-annex"""
+        # Trace transfers separately, and by key
+        words = line.split(None, 3)
+        phase, key = words[0].lower(), None
+        if phase == "transfer" and len(words) > 2:
+            phase, key = "%s-%s" % (phase, words[1].lower()), words[2]
+        elif phase in ("checkpresent", "remove") and len(words) > 1:
+            key = words[1]
+        with trace.span(phase, key):
+            self._handle(line)
+
+    def _handle(self, line):
+        """Handle a request from git-annex, without tracing it"""
+        line = line.split(None, 1)
+        command = line[0]
+
+        # Boring commands -- reply immediately
+        if command == "GETCOST":
+            self.send("COST %d" % REMOTE_COST)
+        elif command == "GETAVAILABILITY":
+            self.send("AVAILABILITY GLOBAL")
+        elif command == "EXTENSIONS":
+            self.send("EXTENSIONS ASYNC")
+
+        # Init commands -- from auth.py
+        elif command == "INITREMOTE":
+            self.auth.initialize()
+
+        elif command == "PREPARE":
+            # Jobs share the credentials: only the first one really prepares
+            # the remote.
+            with self.prepare_lock:
+                if self.prepared:
+                    self.send("PREPARE-SUCCESS")
+                    return
+                for name in swift.CONFIG_NAMES:
+                    self.get_config(name)
+                self.prepared = self.auth.prepare()
+
+        # File transfer commands -- from swift.py
+        elif command == "TRANSFER":
+            subcommand, key, filename = line[1].split(None, 2)
+            try:
+                conn = swift.SwiftConnection(self)
+            except Exception as exc:
+                self.send("TRANSFER-FAILURE %s %s %s" % (subcommand, key, str(exc)))
+                return
 
+            with conn:
                 if subcommand == "STORE":
                     conn.store(key, filename)
                 elif subcommand == "RETRIEVE":
@@ -133,38 +245,45 @@ class Remote(object):
                 else:
                     self.send("UNSUPPORTED-REQUEST")
 
-            elif command == "CHECKPRESENT":
-                conn = swift.SwiftConnection(self)
+        elif command == "CHECKPRESENT":
+            with swift.SwiftConnection(self) as conn:
                 conn.check(line[1])
 
-            elif command == "REMOVE":
-                conn = swift.SwiftConnection(self)
+        elif command == "REMOVE":
+            with swift.SwiftConnection(self) as conn:
                 conn.remove(line[1])
 
-            # Fallback: unsupported command
-            else:
-                self.send("UNSUPPORTED-REQUEST")
+        # Fallback: unsupported command
+        else:
+            self.send("UNSUPPORTED-REQUEST")
 
     # Commands
     def get_config(self, name):
         """Read a configuration value"""
-        self.send("GETCONFIG " + name)
-        msg = self.read().split(None, 1)
+        if name in self.config:
+            return self.config[name]
+        with trace.span("annex-getconfig"):
+            self.send("GETCONFIG " + name)
+            msg = self.read().split(None, 1)
         if msg[0] != "VALUE":
             self.fatal("Expected VALUE, got " + msg[0])
         if len(msg) == 1:
-            return None
+            value = None
         else:
-            return msg[1]
+            value = msg[1]
+        self.config[name] = value
+        return value
 
     def set_config(self, name, value):
         """Set a configuration value"""
         self.send("SETCONFIG %s %s" % (name, value))
+        self.config[name] = value
 
     def get_credentials(self, name):
         """Read user credentials"""
-        self.send("GETCREDS " + name)
-        msg = self.read().split(None, 2)
+        with trace.span("annex-getcreds"):
+            self.send("GETCREDS " + name)
+            msg = self.read().split(None, 2)
         if msg[0] != "CREDS":
             self.fatal("Expected CREDS, got " + msg[0])
         if len(msg) < 3:
@@ -177,15 +296,50 @@ class Remote(object):
         self.send("SETCREDS %s %s %s" % (name, user, password))
 
     def dirhash(self, key):
-        """Get a two level hash associated with key."""
-        self.send("DIRHASH " + key)
-        msg = self.read().split(None, 1)
+        """Get a two level hash associated with key. It is computed locally,
+        once git-annex has confirmed that it gives the same result."""
+        if self.local_dirhash:
+            return hash_dir_mixed(key)
+        value = self.dirhash_request(key)
+        if self.local_dirhash is None:
+            self.local_dirhash = value == hash_dir_mixed(key)
+            if not self.local_dirhash:
+                self.debug("Local DIRHASH differs from git-annex, using DIRHASH requests")
+        return value
+
+    def dirhash_request(self, key):
+        """Ask git-annex for the two level hash associated with key."""
+        with trace.span("annex-dirhash"):
+            self.send("DIRHASH " + key)
+            msg = self.read().split(None, 1)
         if len(msg) != 2:
             self.fatal("Unexpected reply format for DIRHASH")
         if msg[0] != "VALUE":
             self.fatal("Expected VALUE, got " + msg[0])
         return msg[1]
 
+    def get_uuid(self):
+        """Get the UUID of the remote"""
+        if self.uuid is None:
+            with trace.span("annex-getuuid"):
+                self.send("GETUUID")
+                msg = self.read().split(None, 1)
+            if len(msg) != 2 or msg[0] != "VALUE":
+                self.fatal("Expected VALUE, got " + msg[0])
+            self.uuid = msg[1]
+        return self.uuid
+
+    def get_git_dir(self):
+        """Get the path to the git directory of the repository"""
+        if self.git_dir is None:
+            with trace.span("annex-getgitdir"):
+                self.send("GETGITDIR")
+                msg = self.read().split(None, 1)
+            if len(msg) != 2 or msg[0] != "VALUE":
+                self.fatal("Expected VALUE, got " + msg[0])
+            self.git_dir = msg[1]
+        return self.git_dir
+
     # Helpers and wrappers
     def get_swift_credentials(self):
         """Get SWIFT credientials using the auth module"""
@@ -194,3 +348,15 @@ class Remote(object):
     def swift_token_expired(self):
         """Check if the SWIFT credentials have expired using the auth module"""
         return self.auth.swift_token_expired()
+
+    def invalidate_swift_token(self, token):
+        """Forget SWIFT credentials rejected by the server using the auth module"""
+        self.auth.invalidate_swift_token(token)
+
+
+class Job(object):
+    """A job of the ASYNC extension, with the messages git-annex sent to it"""
+
+    def __init__(self, number):
+        self.number = number
+        self.queue = queue.Queue()
@@ -0,0 +1,113 @@
+# Copyright (c) 2014-2016 Thomas Jost and the Contributors
+#
+# This file is part of git-annex-remote-hubic.
+#
+# git-annex-remote-hubic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# git-annex-remote-hubic is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# git-annex-remote-hubic. If not, see <http://www.gnu.org/licenses/>.
+
+"""Refresh the persistent index of a hubiC remote"""
+
+import argparse
+import os.path
+import subprocess
+import sys
+
+from . import auth
+from . import index
+from . import pool
+from .migrate import PseudoRemote
+
+
+def git(*args):
+    """Run a git command and return its output"""
+    return subprocess.check_output(("git",) + args, universal_newlines=True).strip()
+
+
+def remote_configs():
+    """Read the configuration of all the special remotes from the git-annex
+    branch, keeping the most recent one for each UUID"""
+    configs = {}
+    try:
+        log = git("cat-file", "blob", "git-annex:remote.log")
+    except subprocess.CalledProcessError:
+        return configs
+    for line in log.splitlines():
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        config = dict(field.split("=", 1) for field in fields[1:] if "=" in field)
+        timestamp = float(config.get("timestamp", "0").rstrip("s"))
+        if fields[0] not in configs or configs[fields[0]][0] <= timestamp:
+            configs[fields[0]] = (timestamp, config)
+    return {uuid: config for uuid, (_, config) in configs.items()}
+
+
+def main(argv=None):
+    """Refresh the persistent index of a hubiC remote"""
+    parser = argparse.ArgumentParser(
+        prog="git-annex-remote-hubic resync-index",
+        description="List a hubiC remote to refresh its persistent index "
+        "(hubic_persistent_index=yes)")
+    parser.add_argument("remote", help="name or UUID of the remote")
+    parser.add_argument("--token", type=str,
+                        help="OAuth2 refresh token used to log into the hubiC account")
+    args = parser.parse_args(argv)
+
+    git_dir = os.path.abspath(git("rev-parse", "--git-dir"))
+    configs = remote_configs()
+
+    # Find the UUID of the remote
+    try:
+        uuid = git("config", "--get", "remote.%s.annex-uuid" % args.remote)
+    except subprocess.CalledProcessError:
+        uuid = args.remote
+        for remote_uuid, config in configs.items():
+            if config.get("name") == args.remote:
+                uuid = remote_uuid
+    if uuid not in configs:
+        print("Unknown remote: %s" % args.remote, file=sys.stderr)
+        sys.exit(1)
+    config = configs[uuid]
+
+    # Find the OAuth2 refresh token, like git-annex does
+    token = args.token or config.get("hubic_refresh_token")
+    if token is None:
+        creds_filename = os.path.join(git_dir, "annex", "creds", uuid + "-token")
+        try:
+            with open(creds_filename) as creds_file:
+                token = creds_file.read().splitlines()[1]
+        except (IOError, IndexError):
+            print("No credentials found for this remote; use --token", file=sys.stderr)
+            sys.exit(1)
+
+    # Authenticate
+    hubic_auth = auth.HubicAuth(PseudoRemote())
+    hubic_auth.refresh_token = token
+    # Rejected tokens are renewed by the connection, and tokens about to
+    # expire between two pages of the listing
+    conn_pool = pool.ConnectionPool(hubic_auth.get_swift_credentials, max_size=1,
+                                    invalidate=hubic_auth.invalidate_swift_token)
+
+    # And list the remote
+    container = config.get("hubic_container", "default")
+    path = config.get("hubic_path", "")
+    idx = index.PersistentIndex(index.index_filename(git_dir, uuid), container, path)
+    print("Listing /%s/%s" % (container, idx.prefix))
+
+    def _progress(nb_objects):
+        print("%d objects listed" % nb_objects)
+        conn_pool.refresh()
+
+    with conn_pool.connection() as conn:
+        idx.refresh(conn, _progress)
+    conn_pool.close()
@@ -17,73 +17,511 @@
 
 """hubiC interaction using the SWIFT API"""
 
+from concurrent import futures
 import functools
 import hashlib
 import io
+import json
+import mmap
 import os
 import os.path
+import queue
+import threading
+import time
+import urllib.parse
 
-import swiftclient.client
 from swiftclient.exceptions import ClientException
 
+from . import index
+from . import pool
+from . import trace
+
 DEFAULT_CHUNK_SIZE = 2**30  # 1 GB
+AUTO_CHUNK_SIZE_MIN = 2**24  # 16 MB
+AUTO_CHUNK_SIZE_MAX = 2**30  # 1 GB
+AUTO_CHUNK_TIME = 60  # seconds
+AUTO_CHUNKS_PER_CONNECTION = 4
+DEFAULT_UPLOAD_CONCURRENCY = 1
+DEFAULT_DOWNLOAD_CONCURRENCY = 1
+DEFAULT_LISTING_CACHE_TTL = 300  # 5 minutes
+DEFAULT_PROGRESS_INTERVAL = 0.25  # seconds
+DEFAULT_PROGRESS_STEP = 1  # percent of the file size
+STORAGE_FORMATS = ("chunks", "slo")
+DEFAULT_STORAGE_FORMAT = "chunks"
+SLO_MAX_SEGMENTS = 1000  # Default max_manifest_segments of Swift
+SLO_MIN_SEGMENT_SIZE = 2**20  # 1 MB, min_segment_size of Swift before 2.6
+SWIFT_MAX_FILE_SIZE = 5 * 2**30  # 5 GB, default max_file_size of Swift
+DEFAULT_BLOCK_SIZE = 2**20  # 1 MB
+MMAP_WINDOW_SIZE = 2**22  # 4 MB
+DEFAULT_PIPELINE_DEPTH = 4  # blocks
+DEFAULT_SENDFILE = False
+
+# Configuration values read by the remote, fetched once when preparing it
+CONFIG_NAMES = ("hubic_container", "hubic_path", "hubic_chunk_size",
+                "hubic_upload_concurrency", "hubic_download_concurrency",
+                "hubic_persistent_index", "hubic_listing_cache", "hubic_listing_cache_ttl",
+                "hubic_progress_interval", "hubic_progress_step", "hubic_pool_size",
+                "hubic_token_refresh_margin", "hubic_storage_format", "hubic_block_size",
+                "hubic_pipeline_depth", "hubic_sendfile")
 
 class ProgressFile(io.FileIO):
-    """File wrapper that writes read/write progress to the remote"""
-    def __init__(self, remote, *args, **kwds):
-        self._remote = remote
+    """File wrapper that writes read/write progress to a TransferProgress"""
+    def __init__(self, progress, *args, **kwds):
+        self._progress = progress
         super().__init__(*args, **kwds)
 
     def read(self, *args, **kwds):
-        self._remote.send("PROGRESS %d" % self.tell())
+        self._progress.update(0, self.tell())
         return super().read(*args, **kwds)
 
     def write(self, *args, **kwds):
         ret = super().write(*args, **kwds)
-        self._remote.send("PROGRESS %d" % self.tell())
+        self._progress.update(0, self.tell())
         return ret
 
-class ChunkedReader(object):
-    """File wrapper that can only read file chunks"""
-    def __init__(self, file_, offset, size):
+class TransferProgress(object):
+    """Progress of a transfer made of several parts, written to the remote as a
+    single total
+
+    To keep the number of messages low, progress is only written once interval
+    seconds have passed and the total has changed by step bytes since the
+    previous message. finish() writes the exact total."""
+    def __init__(self, remote, interval=0, step=0):
+        self._remote = remote
+        self._interval = interval
+        self._step = max(1, step)
+        self._lock = threading.Lock()
+        self._parts = {}
+        self._last_time = None
+        self._last_total = 0
+
+    def _send(self, total):
+        self._remote.send("PROGRESS %d" % total)
+        self._last_time = time.monotonic()
+        self._last_total = total
+
+    def update(self, part, pos):
+        """Set the current position in a part"""
+        with self._lock:
+            self._parts[part] = pos
+            total = sum(self._parts.values())
+            if abs(total - self._last_total) < self._step:
+                return
+            if self._last_time is None or time.monotonic() - self._last_time >= self._interval:
+                self._send(total)
+
+    def finish(self):
+        """Write the final total"""
+        with self._lock:
+            total = sum(self._parts.values())
+            if total != self._last_total or self._last_time is None:
+                self._send(total)
+
+class ReadPipeline(object):
+    """Read and hash blocks of a file in background threads
+
+    A reader thread reads blocks of the file into a fixed set of buffers, and a
+    hasher thread updates the MD5 checksums with them, while the consumer uses
+    the blocks already hashed, taken from the ready queue. Buffers are given
+    back with release(). Since there are only depth + 1 buffers, reading stops
+    when the consumer is depth blocks behind.
+
+    Items of the ready queue are (buffer, length) tuples, then None at the end
+    of the data, or an exception if reading failed."""
+
+    def __init__(self, file_, offset, size, md5s, block_size, depth):
         self._file = file_
         self._offset = offset
         self._size = size
+        self._md5s = md5s
+        self._free = queue.Queue()
+        for _ in range(depth + 1):
+            self._free.put(memoryview(bytearray(block_size)))
+        self._read = queue.Queue()
+        self.ready = queue.Queue()
+        self._stopping = False
+        self._threads = [threading.Thread(target=trace.wrap(func), daemon=True)
+                         for func in (self._read_blocks, self._hash_blocks)]
+        for thread in self._threads:
+            thread.start()
+
+    def _read_blocks(self):
+        try:
+            self._file.seek(self._offset)
+            pos = 0
+            while pos < self._size and not self._stopping:
+                buf = self._free.get()
+                if buf is None:
+                    break
+                length = self._file.readinto(buf[:min(len(buf), self._size - pos)])
+                if not length:
+                    break
+                self._read.put((buf, length))
+                pos += length
+            self._read.put(None)
+        except Exception as exc:
+            self._read.put(exc)
+
+    def _hash_blocks(self):
+        while True:
+            item = self._read.get()
+            if isinstance(item, tuple):
+                block = item[0][:item[1]]
+                with trace.timer("md5_seconds"):
+                    for md5 in self._md5s:
+                        md5.update(block)
+            self.ready.put(item)
+            if not isinstance(item, tuple):
+                return
+
+    def release(self, buf):
+        """Give back a buffer taken from the ready queue"""
+        self._free.put(buf)
+
+    def stop(self):
+        """Stop reading, and wait for the threads to exit"""
+        self._stopping = True
+        self._free.put(None)
+        for thread in self._threads:
+            thread.join()
+
+class ChunkedReader(object):
+    """File wrapper that can only read file chunks
+
+    The chunk data is hashed as it is read: its checksum is available in the md5
+    attribute. If md5 is given, the running checksum of the whole file (md5
+    updated with this chunk) is available in the global_md5 attribute. Seeking
+    back to the start of the chunk resets both checksums, so that an upload can
+    be retried. If given, progress is called with the position in the chunk
+    after each read.
+
+    The file is read and hashed by blocks of block_size bytes, in buffers that
+    are reused: read() returns views of them, which are only valid until the
+    next call. If depth is more than 0, blocks are read and hashed in
+    background threads, up to depth blocks ahead of the reads (see
+    ReadPipeline). The reader must then be closed once done with.
+    """
+    def __init__(self, file_, offset, size, md5=None, progress=None,
+                 block_size=DEFAULT_BLOCK_SIZE, depth=0):
+        self._file = file_
+        self._offset = offset
+        self.size = size
+        self._global_md5_start = md5
+        self._progress = progress
+        self._block_size = max(1, min(size, block_size))
+        self._depth = depth
+        self._blocks = None
+        self._block = b""
+        self._pos = 0  # Position in the chunk
+        self._start = 0  # Position in the current block
+        self.md5 = self.global_md5 = None
+        self._reset_md5()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _reset_md5(self):
+        self.md5 = hashlib.md5()
+        if self._global_md5_start is not None:
+            self.global_md5 = self._global_md5_start.copy()
 
     def tell(self):
-        return self._file.tell() - self._offset
+        return self._pos
 
-    def seek(self, offset, whence):
+    def seek(self, offset, whence=0):
         if whence == 0:
-            self._file.seek(offset + self._offset)
+            self.close()
+            self._pos = offset
+            if offset == 0:
+                self._reset_md5()
+
+    def close(self):
+        """Stop reading blocks"""
+        if self._blocks is not None:
+            self._blocks.close()
+            self._blocks = None
+        self._block = b""
+        self._start = 0
+
+    def _md5s(self):
+        return [md5 for md5 in (self.md5, self.global_md5) if md5 is not None]
+
+    def _read_blocks(self):
+        """Read and hash the blocks of the chunk, starting at the current
+        position"""
+        buf = memoryview(bytearray(self._block_size))
+        md5s = self._md5s()
+        self._file.seek(self._offset + self._pos)
+        pos = self._pos
+        while pos < self.size:
+            length = self._file.readinto(buf[:min(len(buf), self.size - pos)])
+            if not length:
+                return
+            with trace.timer("md5_seconds"):
+                for md5 in md5s:
+                    md5.update(buf[:length])
+            yield buf[:length]
+            pos += length
+
+    def _read_blocks_pipelined(self):
+        """Same as _read_blocks, but reading and hashing in background
+        threads"""
+        pipeline = ReadPipeline(self._file, self._offset + self._pos, self.size - self._pos,
+                                self._md5s(), self._block_size, self._depth)
+        try:
+            while True:
+                item = pipeline.ready.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                buf, length = item
+                yield buf[:length]
+                pipeline.release(buf)
+        finally:
+            pipeline.stop()
 
     def read(self, size=None):
-        pos = self._file.tell()
-        max_pos = self._offset + self._size
-        if size is None or pos + size >= max_pos:
-            size = max_pos - pos
-        if size <= 0:
-            return ""
-        return self._file.read(size)
+        if size is None or size < 0:
+            # Everything that is left, copied out of the buffers
+            blocks = []
+            block = self.read_block()
+            while block:
+                blocks.append(bytes(block))
+                block = self.read_block()
+            return b"".join(blocks)
+        if self._start == len(self._block):
+            if self._blocks is None:
+                if self._depth > 0:
+                    self._blocks = self._read_blocks_pipelined()
+                else:
+                    self._blocks = self._read_blocks()
+            self._block = next(self._blocks, b"")
+            self._start = 0
+        data = self._block[self._start:self._start + size]
+        self._start += len(data)
+        self._pos += len(data)
+        if self._progress is not None:
+            self._progress(self._pos)
+        return data
+
+    def read_block(self):
+        """Read up to a block"""
+        return self.read(self._block_size)
+
+    def read_to_end(self):
+        """Read the rest of the chunk, so that it is hashed"""
+        while self.read_block():
+            pass
+
+    def send(self, send_range):
+        """Send the whole chunk without reading it, using send_range(fd,
+        offset, size, progress), and hash it in another thread in the meantime.
+        Return what send_range returns."""
+        self.seek(0)
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            hashing = executor.submit(trace.wrap(hash_file), self._file, self._md5s(),
+                                      self._offset, self.size, self._block_size)
+            result = send_range(self._file.fileno(), self._offset, self.size, self._progress)
+            hashing.result()
+        self._pos = self.size
+        return result
+
+def hash_file(src, md5s, offset=0, size=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Update MD5 checksums with size bytes of an open file, starting at offset.
+    The file is mapped in memory a window at a time if possible, so that its
+    pages don't all stay mapped, and read in a reused buffer otherwise."""
+    if size == 0:
+        return
+    try:
+        file_size = os.fstat(src.fileno()).st_size
+        window_start = offset - offset % MMAP_WINDOW_SIZE
+        mapped = mmap.mmap(src.fileno(), min(MMAP_WINDOW_SIZE, file_size - window_start),
+                           access=mmap.ACCESS_READ, offset=window_start)
+    except (OSError, ValueError):
+        # Empty files, files not opened for reading, pipes...
+        mapped = None
+
+    if mapped is not None:
+        end = file_size if size is None else min(file_size, offset + size)
+        pos = offset
+        while True:
+            with mapped, memoryview(mapped) as view:
+                window_end = min(end, window_start + len(view))
+                for start in range(pos, window_end, block_size):
+                    block_end = min(window_end, start + block_size)
+                    with view[start - window_start:block_end - window_start] as block:
+                        with trace.timer("md5_seconds"):
+                            for md5 in md5s:
+                                md5.update(block)
+            pos = window_end
+            window_start += MMAP_WINDOW_SIZE
+            if window_start >= end:
+                return
+            mapped = mmap.mmap(src.fileno(), min(MMAP_WINDOW_SIZE, file_size - window_start),
+                               access=mmap.ACCESS_READ, offset=window_start)
+
+    view = memoryview(bytearray(block_size))
+    src.seek(offset)
+    while size is None or size > 0:
+        length = src.readinto(view if size is None else view[:min(size, block_size)])
+        if not length:
+            break
+        with trace.timer("md5_seconds"):
+            for md5 in md5s:
+                md5.update(view[:length])
+        if size is not None:
+            size -= length
+
+def is_manifest(headers):
+    """Check if an object is a Static Large Object manifest"""
+    return headers.get("x-static-large-object", "").lower() == "true"
+
+def bulk_errors(result):
+    """Get the errors reported in the response of a bulk delete, or of the
+    deletion of a manifest along with its segments, leaving out objects that
+    were already gone"""
+    errors = ["%s (%s)" % (name, status) for name, status in result.get("Errors", [])
+              if not status.startswith("404")]
+    status = result.get("Response Status", "200")
+    if not errors and not status.startswith(("2", "404")):
+        errors.append(status)
+    return errors
+
+def content_md5(headers):
+    """Get the MD5 checksum of the contents of an object from its headers. The
+    ETag of a manifest is computed from the ETags of its segments, so the
+    checksum of a file stored as a manifest is found in its metadata."""
+    if is_manifest(headers):
+        return headers["x-object-meta-annex-global-md5"]
+    return headers["etag"]
+
+def chunk_size_of(headers):
+    """Get the size of the chunks of a file from the headers of its first chunk"""
+    return int(headers.get("x-object-meta-annex-chunk-size", headers["content-length"]))
+
+def file_md5(filename, block_size=DEFAULT_BLOCK_SIZE):
+    """Compute the MD5 checksum of a file"""
+    md5 = hashlib.md5()
+    with trace.span("md5-file"), open(filename, "rb") as src:
+        hash_file(src, [md5], block_size=block_size)
+    return md5
+
+class DownloadState(object):
+    """State of a download, saved next to the downloaded file so that it can be
+    resumed: chunks that were written and checked, and number of bytes written
+    in the other ones"""
+    def __init__(self, filename):
+        self.data_filename = filename
+        self.filename = filename + ".hubic-state"
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, global_md5=None, chunk_size=None, nb_chunks=None):
+        """Start a new download"""
+        self.global_md5 = global_md5
+        self.chunk_size = chunk_size
+        self.nb_chunks = nb_chunks
+        self.done = set()
+        self.partial = {}
+
+    def load(self):
+        """Load the saved state, if any, and if the downloaded file is still there"""
+        if not os.path.exists(self.data_filename) or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, "r") as state:
+                data = json.load(state)
+            self.reset(data["global_md5"], data["chunk_size"], data["nb_chunks"])
+            self.done = set(data["done"])
+            self.partial = {int(idx): size for idx, size in data["partial"].items()}
+        except (ValueError, KeyError, TypeError):
+            self.reset()
+
+    def save(self):
+        """Save the current state"""
+        with self._lock:
+            data = {
+                "global_md5": self.global_md5,
+                "chunk_size": self.chunk_size,
+                "nb_chunks": self.nb_chunks,
+                "done": sorted(self.done),
+                "partial": self.partial,
+            }
+            with open(self.filename, "w") as state:
+                json.dump(data, state)
+
+    def remove(self):
+        """Remove the saved state"""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def chunk_progress(self, idx, size):
+        """Record that size bytes of a chunk were written"""
+        with self._lock:
+            self.partial[idx] = size
+
+    def chunk_failed(self, idx):
+        """Record that the data written for a chunk is invalid"""
+        with self._lock:
+            self.partial.pop(idx, None)
+
+    def chunk_done(self, idx):
+        """Record that a chunk was written and checked, and save the state"""
+        with self._lock:
+            self.partial.pop(idx, None)
+            self.done.add(idx)
+        self.save()
+
+def dump_credentials(remote, creds):
+    """Show new Swift credentials in the debug output, and write them to the
+    file given by GIT_ANNEX_HUBIC_AUTH_FILE"""
+    endpoint, token = creds
+    options = {
+        "auth_token": token,
+        "object_storage_url": endpoint,
+    }
+    remote.debug("Swift credentials: " + str(options))
+    remote.debug('export OS_AUTH_TOKEN="%(auth_token)s"; '
+                 'export OS_STORAGE_URL="%(object_storage_url)s"' % options)
+
+    dump_filename = os.getenv("GIT_ANNEX_HUBIC_AUTH_FILE")
+    if dump_filename is not None:
+        with open(dump_filename, "w") as dump:
+            dump.write('export OS_AUTH_TOKEN="%(auth_token)s"\n'
+                       'export OS_STORAGE_URL="%(object_storage_url)s"\n' % options)
 
 class SwiftConnection(object):
     """Swift connection to hubiC"""
     cache = {
         "container": None,
         "path": None,
-        "conn": None,
-        "last_creds": None,
+        "index": None,
+        "pool": None,
     }
+    cache_lock = threading.Lock()
+
+    # Containers and directory markers known to exist, as (container, path)
+    known_directories = set()
+
+    # Capabilities of the Swift cluster, as advertised by /info
+    capabilities = None
+
+    # Upload throughput of a single connection, in bytes per second, averaged
+    # over the chunks sent so far
+    throughput = None
 
     def __init__(self, remote):
         self.remote = remote
 
         # Reuse everything as much as possible. Mostly interesting for the
-        # connection object, to avoid re-opening HTTP connections and use
+        # connection pool, to avoid re-opening HTTP connections and use
         # pipelining instead.
         self.container = SwiftConnection.cache["container"]
         self.path = SwiftConnection.cache["path"]
-        self.conn = SwiftConnection.cache["conn"]
 
         if self.container is None:
             self.container = remote.get_config("hubic_container")
@@ -95,43 +533,126 @@ class SwiftConnection(object):
             if self.path is None:
                 self.path = ""
 
+        # None means that the chunk size is chosen for each file
         self.chunk_size = remote.get_config("hubic_chunk_size")
         if self.chunk_size is None:
             self.chunk_size = DEFAULT_CHUNK_SIZE
+        elif self.chunk_size.lower() == "auto":
+            self.chunk_size = None
         else:
             self.chunk_size = int(self.chunk_size)
 
-        self.renew_connection()
-
-    def renew_connection(self):
-        """Start a new Swift connection, renewing credentials if necessary"""
-        last_creds = SwiftConnection.cache["last_creds"]
-        creds = self.remote.get_swift_credentials()
-        if last_creds != creds:
-            endpoint, token = creds
-            options = {
-                "auth_token": token,
-                "object_storage_url": endpoint,
-            }
-            self.remote.debug("Swift credentials: " + str(options))
-            self.remote.debug('export OS_AUTH_TOKEN="%(auth_token)s"; '
-                              'export OS_STORAGE_URL="%(object_storage_url)s"' % options)
-
-            dump_filename = os.getenv("GIT_ANNEX_HUBIC_AUTH_FILE")
-            if dump_filename is not None:
-                with open(dump_filename, "w") as dump:
-                    dump.write('export OS_AUTH_TOKEN="%(auth_token)s"\n'
-                               'export OS_STORAGE_URL="%(object_storage_url)s"\n' % options)
-
-            self.conn = swiftclient.client.Connection(os_options=options, auth_version=2, timeout=60)
-
-        # Store new things in the cache
-        SwiftConnection.cache = {
-            "container": self.container,
-            "path": self.path,
-            "conn": self.conn,
-            "last_creds": creds,
-        }
+        # Large files are stored either as linked chunks, or as segments and a
+        # Static Large Object manifest
+        self.storage_format = remote.get_config("hubic_storage_format")
+        if self.storage_format is None:
+            self.storage_format = DEFAULT_STORAGE_FORMAT
+        self.storage_format = self.storage_format.lower()
+        if self.storage_format not in STORAGE_FORMATS:
+            raise ValueError("Unknown storage format: %s" % self.storage_format)
+
+        self.upload_concurrency = remote.get_config("hubic_upload_concurrency")
+        if self.upload_concurrency is None:
+            self.upload_concurrency = DEFAULT_UPLOAD_CONCURRENCY
+        else:
+            self.upload_concurrency = max(1, int(self.upload_concurrency))
+
+        self.download_concurrency = remote.get_config("hubic_download_concurrency")
+        if self.download_concurrency is None:
+            self.download_concurrency = DEFAULT_DOWNLOAD_CONCURRENCY
+        else:
+            self.download_concurrency = max(1, int(self.download_concurrency))
+
+        # Files are read, hashed and downloaded by blocks of this size
+        self.block_size = remote.get_config("hubic_block_size")
+        if self.block_size is None:
+            self.block_size = DEFAULT_BLOCK_SIZE
+        else:
+            self.block_size = max(4096, int(self.block_size))
+
+        # Uploads read and hash this many blocks ahead in other threads. With a
+        # single CPU, this only adds thread switches.
+        self.pipeline_depth = remote.get_config("hubic_pipeline_depth")
+        if self.pipeline_depth is None:
+            self.pipeline_depth = DEFAULT_PIPELINE_DEPTH if (os.cpu_count() or 1) > 1 else 0
+        else:
+            self.pipeline_depth = max(0, int(self.pipeline_depth))
+
+        # With plain HTTP endpoints, uploads can send data straight from the
+        # file to the socket
+        self.sendfile = remote.get_config("hubic_sendfile")
+        if self.sendfile is None:
+            self.sendfile = DEFAULT_SENDFILE
+        else:
+            self.sendfile = self.sendfile.lower() in ("yes", "true", "1")
+
+        self.progress_interval = remote.get_config("hubic_progress_interval")
+        if self.progress_interval is None:
+            self.progress_interval = DEFAULT_PROGRESS_INTERVAL
+        else:
+            self.progress_interval = float(self.progress_interval)
+
+        self.progress_step = remote.get_config("hubic_progress_step")
+        if self.progress_step is None:
+            self.progress_step = DEFAULT_PROGRESS_STEP
+        else:
+            self.progress_step = float(self.progress_step)
+
+        # Optionally, answer CHECKPRESENT from an index of the remote: either
+        # kept in the repository and refreshed on demand, or a listing of the
+        # whole remote
+        with SwiftConnection.cache_lock:
+            self.index = SwiftConnection.cache["index"]
+            if self.index is None:
+                persistent_index = remote.get_config("hubic_persistent_index")
+                if persistent_index is not None \
+                   and persistent_index.lower() in ("yes", "true", "1"):
+                    filename = index.index_filename(remote.get_git_dir(), remote.get_uuid())
+                    self.index = index.PersistentIndex(filename, self.container, self.path)
+            if self.index is None:
+                listing_cache = remote.get_config("hubic_listing_cache")
+                if listing_cache is not None and listing_cache.lower() in ("yes", "true", "1"):
+                    ttl = remote.get_config("hubic_listing_cache_ttl")
+                    ttl = DEFAULT_LISTING_CACHE_TTL if ttl is None else int(ttl)
+                    self.index = index.ListingIndex(self.container, self.path, ttl)
+            SwiftConnection.cache["index"] = self.index
+
+            # Connections can't be shared between threads: each command
+            # borrows one from the pool, and so do parallel transfers.
+            self.pool = SwiftConnection.cache["pool"]
+            if self.pool is None:
+                pool_size = remote.get_config("hubic_pool_size")
+                pool_size = pool.DEFAULT_POOL_SIZE if pool_size is None else int(pool_size)
+                self.pool = pool.ConnectionPool(
+                    remote.get_swift_credentials, pool_size,
+                    on_renew=functools.partial(dump_credentials, remote),
+                    invalidate=remote.invalidate_swift_token)
+
+            # Store new things in the cache
+            SwiftConnection.cache.update({
+                "container": self.container,
+                "path": self.path,
+                "pool": self.pool,
+            })
+
+        self.conn = self.pool.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Give the connection back to the pool"""
+        if self.conn is not None:
+            self.pool.put(self.conn)
+            self.conn = None
+
+    def new_progress(self, size=None):
+        """Track the progress of a transfer of size bytes"""
+        step = 0 if size is None else int(size * self.progress_step / 100)
+        return TransferProgress(self.remote, self.progress_interval, step)
 
     def get_path(self, key):
         """Get the full path for storing a key"""
@@ -144,90 +665,324 @@ class SwiftConnection(object):
 
     def ensure_directory_exists(self, path):
         """Makes sure the directory exists, by creating it if necessary"""
-        self.remote.debug("ensure directory exists '%s'" % path)
-
         # If the container is "default", we need to create application/directory
         # objects so that directories are visible in the web UI. But in
         # non-default containers, we don't care about that: we only need to make
         # sure that the container itself exists.
         if self.container != "default":
-            self.conn.put_container(self.container)
+            if (self.container, "") not in SwiftConnection.known_directories:
+                self.remote.debug("ensure container exists '%s'" % self.container)
+                self.conn.put_container(self.container)
+                SwiftConnection.known_directories.add((self.container, ""))
             return
 
         # In the "default" container, check for directories and subdirectories,
-        # and create them if needed.
-        path_components = path.split("/")
-        for idx in range(len(path_components)):
+        # and create them if needed. Directories seen once are not checked
+        # again.
+        path_components = path.strip("/").split("/")
+        for idx in range(1, len(path_components) + 1):
             path = "/".join(path_components[:idx])
+            if path == "" or (self.container, path) in SwiftConnection.known_directories:
+                continue
+
+            if self.index is None or not self.index.has_directory(path):
+                self.remote.debug("ensure directory exists '%s'" % path)
+                with trace.span("ensure-directory"):
+                    try:
+                        status = self.conn.head_object(self.container, path)
+                        if status["content-type"] != "application/directory":
+                            raise ValueError("Directory %s has type %s"
+                                             % (path, status["content-type"]))
+                    except ClientException as exc:
+                        if exc.http_status != 404:
+                            raise exc
+                        self.conn.put_object(self.container, path, None,
+                                             content_type="application/directory")
+                if self.index is not None:
+                    self.index.add_directory(path)
+            SwiftConnection.known_directories.add((self.container, path))
+
+
+    def chunk_path(self, path, idx):
+        """Get the path of a chunk, given the path of the key"""
+        return path if idx == 0 else "%s/chunk%04d" % (path, idx)
 
+    def next_chunk_path(self, path, idx, headers):
+        """Get the path of the chunk following chunk idx of a file, given the
+        headers of chunk idx, or None if it is the last one. The path is not
+        taken from the link found in the metadata, which still points to the
+        original location of files copied from another container."""
+        if "x-object-meta-annex-next-chunk" not in headers:
+            return None
+        return self.chunk_path(path, idx + 1)
+
+    def segment_path(self, path, idx):
+        """Get the path of a segment of a file stored as a manifest"""
+        return "%s/segment%04d" % (path, idx)
+
+    def chunk_headers(self, path, idx, chunks, md5_digest=None):
+        """Get the metadata headers of a chunk"""
+        # Files stored as a single chunk are plain objects: their ETag is the
+        # global MD5 checksum.
+        nb_chunks = len(chunks)
+        if nb_chunks == 1:
+            return {}
+        headers = {
+            "x-object-meta-annex-chunks": str(nb_chunks),
+            "x-object-meta-annex-chunk-size": str(chunks[0]["size"]),
+        }
+        if md5_digest is not None:
+            headers["x-object-meta-annex-global-md5"] = md5_digest
+        if idx < nb_chunks - 1:
+            headers["x-object-meta-annex-next-chunk"] = self.chunk_path(path, idx + 1)
+        return headers
+
+    def auto_chunk_size(self, size):
+        """Choose the chunk size for a file of size bytes: small enough to give
+        several chunks to each upload connection, and for a chunk to be sent in
+        about AUTO_CHUNK_TIME seconds, so that little is lost when an upload is
+        interrupted."""
+        chunk_size = AUTO_CHUNK_SIZE_MAX
+        if self.upload_concurrency > 1:
+            chunk_size = min(chunk_size,
+                             size // (AUTO_CHUNKS_PER_CONNECTION * self.upload_concurrency))
+        if SwiftConnection.throughput is not None:
+            chunk_size = min(chunk_size, int(SwiftConnection.throughput * AUTO_CHUNK_TIME))
+        chunk_size = max(chunk_size, AUTO_CHUNK_SIZE_MIN)
+        # Round up to a whole number of MB
+        return -(-chunk_size // 2**20) * 2**20
+
+    def slo_segment_size(self, size, chunk_size):
+        """Choose the size of the segments of a file of size bytes stored as a
+        Static Large Object: chunk_size, raised if needed to fit the limits
+        advertised by the Swift cluster on the number of segments and, with
+        older versions of Swift, on their size. Return None if the file can't
+        be stored as a single manifest."""
+        capabilities = self.get_capabilities()
+        if capabilities and "slo" not in capabilities:
+            return None
+        # Without /info, assume an old version of Swift
+        slo = capabilities.get("slo", {"min_segment_size": SLO_MIN_SEGMENT_SIZE})
+        max_segments = slo.get("max_manifest_segments", SLO_MAX_SEGMENTS)
+        chunk_size = max(chunk_size, slo.get("min_segment_size", 1))
+        if -(-size // chunk_size) > max_segments:
+            chunk_size = -(-size // max_segments)
+        max_file_size = capabilities.get("swift", {}).get("max_file_size", SWIFT_MAX_FILE_SIZE)
+        if chunk_size > max_file_size:
+            return None
+        return chunk_size
+
+    def record_throughput(self, size, duration):
+        """Update the average upload throughput with a chunk of size bytes sent
+        in duration seconds"""
+        if size < 2**20 or duration <= 0:
+            return
+        throughput = size / duration
+        if SwiftConnection.throughput is not None:
+            throughput = 0.7 * SwiftConnection.throughput + 0.3 * throughput
+        SwiftConnection.throughput = throughput
+
+    def list_chunks(self, path):
+        """List the chunks stored at path, with a single request (so at most
+        10000 of them)"""
+        _, objects = self.conn.get_container(self.container, prefix=path)
+        return {obj["name"]: obj for obj in objects
+                if obj["name"] == path or obj["name"].startswith(path + "/chunk")
+                or obj["name"].startswith(path + "/segment")}
+
+    def store_chunk(self, conn, reader, idx, chunks, stored=None):
+        """Upload a chunk using conn, and check its MD5 checksum. If stored is the
+        listing entry of a chunk already stored at this path, the upload is
+        skipped if it has the same contents. Return True if the chunk was sent."""
+        nb_chunks = len(chunks)
+
+        # Resume interrupted uploads: hash the chunk and compare it with the one
+        # already on the server
+        if stored is not None and stored["bytes"] == reader.size:
+            reader.seek(0)
+            with trace.span("resume-hash", chunk=idx):
+                reader.read_to_end()
+            if reader.md5.hexdigest() == stored["hash"]:
+                self.remote.debug("Chunk %d/%d already stored" % (idx + 1, nb_chunks))
+                return False
+
+        # Expired OpenStack tokens are renewed by the connection
+        self.remote.debug("Sending chunk %d/%d" % (idx + 1, nb_chunks))
+        reader.seek(0)
+        start_time = time.monotonic()
+        with trace.span("upload-chunk", chunk=idx):
+            if self.sendfile and conn.can_sendfile():
+                etag = reader.send(functools.partial(conn.put_object_sendfile, self.container,
+                                                     chunks[idx]["path"],
+                                                     headers=chunks[idx]["headers"]))
+            else:
+                etag = conn.put_object(self.container, chunks[idx]["path"],
+                                       contents=reader, content_length=reader.size,
+                                       headers=chunks[idx]["headers"])
+            trace.count("bytes_sent", reader.size)
+        self.record_throughput(reader.size, time.monotonic() - start_time)
+
+        # Check chunk MD5
+        md5_digest = reader.md5.hexdigest()
+        if etag != md5_digest:
+            raise ValueError("Checksum mismatch for chunk %d: %s != %s"
+                             % (idx + 1, md5_digest, etag))
+        return True
+
+    def store_serial(self, filename, chunks, progress, stored):
+        """Upload chunks one after another, and return the global MD5 checksum"""
+        # Compute MD5 checksums while sending the data, so that the file is only
+        # read once: the global one, and one for each chunk. The checksum of the
+        # first chunk is also the checksum of the start of the file, so it is
+        # only computed once.
+        md5 = None
+        with open(filename, "rb") as src:
+            for idx, chunk in enumerate(chunks):
+                # Tokens about to expire are renewed between chunks
+                self.pool.refresh()
+                with ChunkedReader(src, chunk["offset"], chunk["size"], md5,
+                                   functools.partial(progress.update, idx),
+                                   self.block_size, self.pipeline_depth) as reader:
+                    chunk["sent"] = self.store_chunk(self.conn, reader, idx, chunks,
+                                                     stored.get(chunk["path"]))
+                chunk["md5_digest"] = reader.md5.hexdigest()
+                md5 = reader.md5.copy() if md5 is None else reader.global_md5
+        return md5.hexdigest()
+
+    def store_parallel(self, filename, chunks, progress, stored):
+        """Upload several chunks at the same time, and return the global MD5
+        checksum"""
+        def _store(idx, chunk):
+            # Each upload has its own connection and its own file handle
+            with self.pool.connection() as conn, open(filename, "rb") as src, \
+                 ChunkedReader(src, chunk["offset"], chunk["size"],
+                               progress=functools.partial(progress.update, idx),
+                               block_size=self.block_size,
+                               depth=self.pipeline_depth) as reader:
+                chunk["sent"] = self.store_chunk(conn, reader, idx, chunks,
+                                                 stored.get(chunk["path"]))
+                chunk["md5_digest"] = reader.md5.hexdigest()
+
+        # Chunks are not sent in order, so the global MD5 checksum is computed
+        # separately. The data it reads has usually just been read by the
+        # uploads, so it comes from the page cache.
+        with futures.ThreadPoolExecutor(max_workers=self.upload_concurrency + 1) as executor:
+            md5_task = executor.submit(self.remote.in_job(file_md5), filename, self.block_size)
+            tasks = [executor.submit(self.remote.in_job(_store), idx, chunk)
+                     for idx, chunk in enumerate(chunks)]
             try:
-                status = self.conn.head_object(self.container, "path")
-                if status["content-type"] != "application/directory":
-                    self.remote.fatal("Directory %s has type %s" % (path, status["content-type"]))
-            except ClientException as exc:
-                if exc.http_status != 404:
-                    self.conn.put_object(self.container, path, None, content_type="application/directory")
+                for task in futures.as_completed(tasks):
+                    task.result()
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+            return md5_task.result().hexdigest()
+
+    def finalize_chunks(self, path, chunks, md5_digest, stored):
+        """Add the global MD5 checksum to the metadata of linked chunks"""
+        # Do it in reverse order so that the first chunk is only complete when
+        # all the others are: if it already has the right global checksum and
+        # no chunk was sent, there is nothing left to do.
+        if stored and not any(chunk["sent"] for chunk in chunks):
+            headers = self.conn.head_object(self.container, path)
+            if headers.get("x-object-meta-annex-global-md5") == md5_digest:
+                return
+        if len(chunks) > 1:
+            for idx in reversed(range(len(chunks))):
+                self.remote.debug("Finalizing chunk %d/%d" % (idx + 1, len(chunks)))
+                headers = self.chunk_headers(path, idx, chunks, md5_digest)
+                self.conn.post_object(self.container, chunks[idx]["path"], headers)
 
+    def store_manifest(self, path, chunks, md5_digest):
+        """Make segments available as a single object by uploading a Static
+        Large Object manifest, and return its ETag. The global MD5 checksum is
+        stored in its metadata."""
+        self.remote.debug("Sending manifest of %d segments" % len(chunks))
+        manifest = [{
+            "path": "/%s/%s" % (self.container, chunk["path"]),
+            "etag": chunk["md5_digest"],
+            "size_bytes": chunk["size"],
+        } for chunk in chunks]
+        headers = {"x-object-meta-annex-global-md5": md5_digest}
+        return self.conn.put_object(self.container, path, contents=json.dumps(manifest),
+                                    headers=headers, query_string="multipart-manifest=put")
 
     def store(self, key, filename):
         """Store filename to key"""
-        # Prepare chunks
         size = os.path.getsize(filename)
-        chunks = []
-        while size > len(chunks) * self.chunk_size:
-            new_chunk = {
-                "md5": hashlib.md5(),
-                "offset": len(chunks) * self.chunk_size,
-                "size": min(self.chunk_size, size - len(chunks) * self.chunk_size)
-            }
-            chunks.append(new_chunk)
-
-        # Compute MD5 checksums: the global one (for ETag) and one for each chunk
-        md5 = hashlib.md5()
-        with open(filename, "rb") as src:
-            for chunk in chunks:
-                reader = ChunkedReader(src, chunk["offset"], chunk["size"])
-                for data_chunk in iter(functools.partial(reader.read, 65536), ""):
-                    md5.update(data_chunk)
-                    chunk["md5"].update(data_chunk)
-                chunk["md5_digest"] = chunk["md5"].hexdigest()
-        md5_digest = md5.hexdigest()
-
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = self.auto_chunk_size(size)
         path = self.get_path(key)
-        self.ensure_directory_exists(os.path.dirname(path))
+
+        # Check the limits on Static Large Objects before uploading anything
+        slo = self.storage_format == "slo"
+        if slo and size > chunk_size:
+            segment_size = self.slo_segment_size(size, chunk_size)
+            if segment_size is None:
+                self.remote.debug("File too large for a Static Large Object, storing linked chunks")
+                slo = False
+            elif segment_size != chunk_size:
+                self.remote.debug("Using segments of %d bytes to fit the limits of the server"
+                                  % segment_size)
+                chunk_size = segment_size
 
         try:
-            with ProgressFile(self.remote, filename, "rb") as contents:
-                for idx, chunk in enumerate(chunks):
-                    this_path = path if idx == 0 else "%s/chunk%04d" % (path, idx)
-
-                    # Chunk metadata
-                    headers = {
-                        "x-object-meta-annex-chunks": str(len(chunks)),
-                        "x-object-meta-annex-global-md5": md5_digest,
-                    }
-                    if idx < len(chunks) - 1:
-                        headers["x-object-meta-annex-next-chunk"] = "%s/chunk%04d" % (path, idx + 1)
-
-                    # Try 3 times, in case of expiring OpenStack tokens
-                    for nb_try in range(3):
-                        self.remote.debug("Sending chunk %d/%d, try %d"
-                                          % (idx + 1, len(chunks), nb_try + 1))
-                        contents.seek(chunk["offset"])
-                        try:
-                            self.conn.put_object(self.container, this_path,
-                                                 contents=contents, content_length=chunk["size"],
-                                                 etag=chunk["md5_digest"], headers=headers)
-                        except ClientException as exc:
-                            if exc.http_status == 401 and self.remote.swift_token_expired():
-                                # Retry!
-                                self.renew_connection()
-                                continue
-                            else:
-                                raise exc
-
-                        # Chunk upload successful: break the retry loop
-                        break
+            self.ensure_directory_exists(os.path.dirname(path))
+
+            # If a previous upload of this file was interrupted, some chunks may
+            # already be there. When the chunk size is chosen automatically, use
+            # the same one as this upload.
+            stored = {}
+            if size > chunk_size or (self.chunk_size is None and size > AUTO_CHUNK_SIZE_MIN):
+                stored = self.list_chunks(path)
+            if slo:
+                first_path, second_path = self.segment_path(path, 0), self.segment_path(path, 1)
+            else:
+                first_path, second_path = path, self.chunk_path(path, 1)
+            if self.chunk_size is None and first_path in stored and second_path in stored:
+                chunk_size = stored[first_path]["bytes"]
+
+            # Prepare chunks. Even an empty file needs one (empty) chunk.
+            chunks = []
+            while size > len(chunks) * chunk_size or len(chunks) == 0:
+                new_chunk = {
+                    "offset": len(chunks) * chunk_size,
+                    "size": min(chunk_size, size - len(chunks) * chunk_size)
+                }
+                chunks.append(new_chunk)
+
+            # Files stored as a single chunk are always plain objects
+            slo = slo and len(chunks) > 1
+            for idx, chunk in enumerate(chunks):
+                if slo:
+                    chunk["path"] = self.segment_path(path, idx)
+                    chunk["headers"] = {}
+                else:
+                    chunk["path"] = self.chunk_path(path, idx)
+                    chunk["headers"] = self.chunk_headers(path, idx, chunks)
+
+            progress = self.new_progress(size)
+            if self.upload_concurrency > 1 and len(chunks) > 1:
+                md5_digest = self.store_parallel(filename, chunks, progress, stored)
+            else:
+                md5_digest = self.store_serial(filename, chunks, progress, stored)
+            progress.finish()
+
+            with trace.span("finalize"):
+                if slo:
+                    etag = self.store_manifest(path, chunks, md5_digest)
+                else:
+                    self.finalize_chunks(path, chunks, md5_digest, stored)
+
+            if self.index is not None:
+                self.index.forget(key)
+                if slo:
+                    self.index.add(path, size, etag)
+                else:
+                    for chunk in chunks:
+                        self.index.add(chunk["path"], chunk["size"], chunk["md5_digest"])
 
             self.remote.send("TRANSFER-SUCCESS STORE " + key)
 
@@ -238,66 +993,253 @@ class SwiftConnection(object):
             self.remote.send("TRANSFER-FAILURE STORE %s %s" % (key, str(exc)))
 
 
-    def retrieve(self, key, filename):
-        """Retrieve key to filename"""
-        md5 = hashlib.md5()
-        path = self.get_path(key)
+    def check_chunk_metadata(self, headers, chunk_idx, nb_chunks=None, global_etag=None):
+        """Read the number of chunks and the global MD5 checksum from the
+        metadata of a chunk, and check that they are consistent with the values
+        found in the previous chunks"""
+        meta_nb_chunks = int(headers.get("x-object-meta-annex-chunks", 1))
+        meta_global_etag = headers.get("x-object-meta-annex-global-md5", content_md5(headers))
+        if meta_nb_chunks > 1 and "x-object-meta-annex-global-md5" not in headers:
+            raise ValueError("Incomplete upload: chunk %d has no global MD5 checksum" % chunk_idx)
 
-        nb_chunks = None
-        chunk_idx = 0
-        global_etag = None
+        if nb_chunks is not None and nb_chunks != meta_nb_chunks:
+            raise ValueError("Inconsistent number of chunks: %d != %d (%d)"
+                             % (nb_chunks, meta_nb_chunks, chunk_idx))
+        if global_etag is not None and global_etag != meta_global_etag:
+            raise ValueError("Inconsistent global MD5 checksum: %s != %s (%d)"
+                             % (global_etag, meta_global_etag, chunk_idx))
+        return meta_nb_chunks, meta_global_etag
+
+    def get_chunk(self, conn, path, start=0):
+        """Start downloading a chunk using conn, from byte start if possible.
+        Return the headers, the body and the actual start."""
+        headers = {"Range": "bytes=%d-" % start} if start > 0 else None
 
+        # Expired OpenStack tokens are renewed by the connection
         try:
-            with ProgressFile(self.remote, filename, "wb") as dst:
-                while path is not None:
-                    chunk_idx += 1
-                    self.remote.debug("Getting chunk %d" % chunk_idx)
-
-                    headers, body = self.conn.get_object(self.container, path, resp_chunk_size=65536)
-
-                    # Read chunk metadata
-                    meta_nb_chunks = int(headers.get("x-object-meta-annex-chunks", 1))
-                    meta_global_etag = headers.get("x-object-meta-annex-global-md5", headers["etag"])
-
-                    # Check for consistency
-                    if nb_chunks is None:
-                        nb_chunks = meta_nb_chunks
-                    elif nb_chunks != meta_nb_chunks:
-                        raise ValueError("Inconsistent number of chunks: %d != %d (%d)"
-                                         % (nb_chunks, meta_nb_chunks, chunk_idx))
-                    if global_etag is None:
-                        global_etag = meta_global_etag
-                    elif global_etag != meta_global_etag:
-                        raise ValueError("Inconsistent global MD5 checksum: %s != %s (%d)"
-                                         % (global_etag, meta_global_etag, chunk_idx))
-
-                    # Path of the next chunk
-                    path = headers.get("x-object-meta-annex-next-chunk", None)
-
-                    # Write chunk to file
-                    chunk_md5 = hashlib.md5()
+            headers, body = conn.get_object(self.container, path,
+                                            resp_chunk_size=self.block_size, headers=headers)
+        except ClientException as exc:
+            if exc.http_status == 416 and start > 0:
+                # Invalid range: get the whole chunk
+                return self.get_chunk(conn, path)
+            raise exc
+        return headers, body, start
+
+    def retrieve_serial(self, path, filename, state, progress):
+        """Download chunks one after another, following the links between
+        them. Return the MD5 checksum of the data and the expected one."""
+        md5 = hashlib.md5()
+        nb_chunks = state.nb_chunks
+        global_etag = state.global_md5
+        idx = start = offset = 0
+        mode = "wb"
+
+        # Resume an interrupted download after the chunks that were already
+        # written. Later chunks are downloaded again.
+        if global_etag is not None:
+            while idx in state.done:
+                idx += 1
+            start = state.partial.get(idx, 0)
+            state.done = set(range(idx))
+            state.partial = {idx: start}
+            offset = idx * state.chunk_size
+            mode = "r+b"
+
+        with ProgressFile(progress, filename, mode) as dst:
+            hash_file(dst, [md5], 0, offset, self.block_size)
+
+            chunk_path = self.chunk_path(path, idx)
+            while chunk_path is not None:
+                self.remote.debug("Getting chunk %d" % (idx + 1))
+
+                # Tokens about to expire are renewed between chunks
+                self.pool.refresh()
+                headers, body, start = self.get_chunk(self.conn, chunk_path, start)
+                nb_chunks, global_etag = self.check_chunk_metadata(headers, idx + 1,
+                                                                   nb_chunks, global_etag)
+                if state.global_md5 is None:
+                    state.reset(global_etag, chunk_size_of(headers), nb_chunks)
+
+                # Path of the next chunk
+                chunk_path = self.next_chunk_path(path, idx, headers)
+
+                # Hash what was already written. The checksum of the first
+                # chunk is also the checksum of the start of the file, so the
+                # data only needs to be hashed once. Later chunks are only
+                # checked by the global checksum, so they are hashed once too:
+                # if one of them is corrupted, the whole file is downloaded
+                # again.
+                chunk_md5 = hashlib.md5() if offset == 0 else None
+                md5s = [chunk_md5] if offset == 0 else [md5]
+                hash_file(dst, md5s, offset, start, self.block_size)
+                dst.seek(offset + start)
+                dst.truncate()
+
+                # Write chunk to file
+                written = start
+                with trace.span("download-chunk", chunk=idx):
                     for chunk in body:
                         dst.write(chunk)
-                        md5.update(chunk)
-                        chunk_md5.update(chunk)
+                        with trace.timer("md5_seconds"):
+                            for checksum in md5s:
+                                checksum.update(chunk)
+                        written += len(chunk)
+                        state.chunk_progress(idx, written)
                     dst.flush()
+                    trace.count("bytes_received", written - start)
+                if offset == 0:
+                    md5 = chunk_md5.copy()
 
-                    # Check chunk MD5
+                    # Check the MD5 of the first chunk
                     chunk_md5_digest = chunk_md5.hexdigest()
-                    if chunk_md5_digest != headers["etag"]:
+                    if chunk_md5_digest != content_md5(headers):
+                        state.chunk_failed(idx)
                         raise ValueError("Checksum mismatch for chunk %d: %s != %s"
-                                         % (chunk_idx, chunk_md5_digest, headers["etag"]))
+                                         % (idx + 1, chunk_md5_digest, content_md5(headers)))
+                state.chunk_done(idx)
+
+                idx += 1
+                offset += written
+                start = 0
+
+        return md5.hexdigest(), global_etag
+
+    def retrieve_parallel(self, path, filename, state, progress):
+        """Download several chunks at the same time, writing each of them at its
+        offset in the file. Return the MD5 checksum of the data and the expected
+        one."""
+        # The first chunk tells how many chunks there are and how large they
+        # are. The other ones have deterministic paths, so they don't need to be
+        # found by following the links between chunks. When resuming a download,
+        # these values are already known.
+        first_chunk = None
+        if state.global_md5 is None:
+            self.remote.debug("Getting chunk 1")
+            first_chunk = self.get_chunk(self.conn, path)
+            nb_chunks, global_etag = self.check_chunk_metadata(first_chunk[0], 1)
+            state.reset(global_etag, chunk_size_of(first_chunk[0]), nb_chunks)
+        nb_chunks = state.nb_chunks
+        global_etag = state.global_md5
+        chunk_size = state.chunk_size
+
+        def _write(fd, idx, headers, body, start):
+            offset = idx * chunk_size
+            chunk_md5 = hashlib.md5()
+            if start > 0:
+                with open(filename, "rb") as src:
+                    hash_file(src, [chunk_md5], offset, start, self.block_size)
+
+            written = start
+            with trace.span("download-chunk", chunk=idx):
+                for chunk in body:
+                    os.pwrite(fd, chunk, offset + written)
+                    written += len(chunk)
+                    with trace.timer("md5_seconds"):
+                        chunk_md5.update(chunk)
+                    state.chunk_progress(idx, written)
+                    progress.update(idx, written)
+                trace.count("bytes_received", written - start)
+
+            # Check chunk MD5
+            chunk_md5_digest = chunk_md5.hexdigest()
+            if chunk_md5_digest != content_md5(headers):
+                state.chunk_failed(idx)
+                raise ValueError("Checksum mismatch for chunk %d: %s != %s"
+                                 % (idx + 1, chunk_md5_digest, content_md5(headers)))
+            state.chunk_done(idx)
+
+        def _download(fd, idx):
+            # Each download has its own connection
+            self.remote.debug("Getting chunk %d" % (idx + 1))
+            with self.pool.connection() as conn:
+                headers, body, start = self.get_chunk(conn, self.chunk_path(path, idx),
+                                                      state.partial.get(idx, 0))
+                self.check_chunk_metadata(headers, idx + 1, nb_chunks, global_etag)
+                size = start + int(headers["content-length"])
+                if size > chunk_size or (size != chunk_size and idx < nb_chunks - 1):
+                    raise ValueError("Unexpected size for chunk %d: %d" % (idx + 1, size))
+                _write(fd, idx, headers, body, start)
+
+        flags = os.O_WRONLY | os.O_CREAT
+        if first_chunk is not None:
+            flags |= os.O_TRUNC
+        fd = os.open(filename, flags, 0o666)
+        try:
+            # Preallocate the file up to the last chunk, whose size is unknown
+            file_size = os.fstat(fd).st_size
+            if file_size < chunk_size * (nb_chunks - 1):
+                os.ftruncate(fd, chunk_size * (nb_chunks - 1))
+            for idx in state.done:
+                progress.update(idx, min(chunk_size, file_size - idx * chunk_size))
+
+            with futures.ThreadPoolExecutor(max_workers=self.download_concurrency) as executor:
+                tasks = []
+                if first_chunk is not None:
+                    tasks.append(executor.submit(self.remote.in_job(_write), fd, 0, *first_chunk))
+                tasks += [executor.submit(self.remote.in_job(_download), fd, idx)
+                          for idx in range(nb_chunks)
+                          if idx not in state.done and (idx > 0 or first_chunk is None)]
+                try:
+                    for task in futures.as_completed(tasks):
+                        task.result()
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+                    raise
+        finally:
+            os.close(fd)
+
+        # Chunks were not written in order, so the global MD5 checksum has to be
+        # computed afterwards. The data usually comes from the page cache.
+        if nb_chunks == 1 and first_chunk is not None:
+            return content_md5(first_chunk[0]), global_etag
+        return file_md5(filename, self.block_size).hexdigest(), global_etag
+
+    def retrieve(self, key, filename):
+        """Retrieve key to filename"""
+        path = self.get_path(key)
+
+        # If a previous download of the same data was interrupted, resume it
+        state = DownloadState(filename)
+        state.load()
+
+        def _failed():
+            # Keep the data already downloaded if the download can be resumed
+            if state.global_md5 is not None:
+                state.save()
+            elif os.path.exists(filename):
+                os.remove(filename)
+
+        try:
+            if state.global_md5 is not None:
+                headers = self.conn.head_object(self.container, path)
+                nb_chunks, global_etag = self.check_chunk_metadata(headers, 1)
+                if (global_etag, chunk_size_of(headers), nb_chunks) \
+                   == (state.global_md5, state.chunk_size, state.nb_chunks):
+                    self.remote.debug("Resuming download: %d chunk(s) already there"
+                                      % len(state.done))
+                else:
+                    self.remote.debug("Stored data changed, restarting download")
+                    state.reset()
+
+            progress = self.new_progress(index.key_size(key))
+            if self.download_concurrency > 1:
+                md5_digest, global_etag = self.retrieve_parallel(path, filename, state, progress)
+            else:
+                md5_digest, global_etag = self.retrieve_serial(path, filename, state, progress)
+            progress.finish()
 
         except KeyboardInterrupt:
-            os.remove(filename)
+            _failed()
             self.remote.send("TRANSFER-FAILURE RETRIEVE %s Interrupted by user" % key)
             raise
         except Exception as exc:
-            os.remove(filename)
+            _failed()
             self.remote.send("TRANSFER-FAILURE RETRIEVE %s %s" % (key, str(exc)))
             return
 
-        md5_digest = md5.hexdigest()
+        state.remove()
         if md5_digest != global_etag:
             os.remove(filename)
             self.remote.send("TRANSFER-FAILURE RETRIEVE %s Checksum mismatch" % key)
@@ -305,17 +1247,86 @@ class SwiftConnection(object):
             self.remote.send("TRANSFER-SUCCESS RETRIEVE " + key)
 
 
+    def check_index(self, key):
+        """Check if key is present using the index. Return False if the index
+        can't tell."""
+        try:
+            with SwiftConnection.cache_lock:
+                if self.index.expired():
+                    self.remote.debug("Listing container %s" % self.container)
+                    self.index.refresh(self.conn)
+
+            entry = self.index.get(key)
+            if entry is None:
+                if not self.index.authoritative:
+                    return False
+                self.remote.send("CHECKPRESENT-FAILURE " + key)
+                return True
+            nb_chunks = len(entry["chunks"])
+            if sorted(entry["chunks"]) != list(range(nb_chunks)):
+                if not self.index.authoritative:
+                    return False
+                self.remote.send("CHECKPRESENT-FAILURE %s Missing chunks" % key)
+                return True
+
+            # A single object of the expected size, or smaller than a chunk,
+            # can't be part of a larger file. This is only trusted from a
+            # fresh listing: the file may have been removed from another
+            # repository since it was recorded in a persistent index.
+            size = sum(chunk_size for chunk_size, _ in entry["chunks"].values())
+            expected_size = index.key_size(key)
+            if self.index.authoritative and nb_chunks == 1 \
+               and (size == expected_size
+                    or (expected_size is None and self.chunk_size is not None
+                        and size < self.chunk_size)):
+                self.remote.send("CHECKPRESENT-SUCCESS " + key)
+                return True
+
+            # Otherwise the metadata of the first chunk, which is removed
+            # before the other ones, tells if the file is still there and how
+            # many chunks there should be.
+            self.remote.debug("Checking chunk 1")
+            headers = self.conn.head_object(self.container, entry["path"])
+            meta_nb_chunks = int(headers.get("x-object-meta-annex-chunks", 1))
+            if meta_nb_chunks > 1 and "x-object-meta-annex-global-md5" not in headers:
+                self.remote.send("CHECKPRESENT-FAILURE %s Incomplete upload" % key)
+            elif meta_nb_chunks == nb_chunks:
+                self.remote.send("CHECKPRESENT-SUCCESS " + key)
+            else:
+                if not self.index.authoritative:
+                    return False
+                self.remote.send("CHECKPRESENT-FAILURE %s Found %d chunks instead of %d"
+                                 % (key, nb_chunks, meta_nb_chunks))
+        except KeyboardInterrupt:
+            self.remote.send("CHECKPRESENT-UNKNOWN %s Interrupted by user" % key)
+            raise
+        except ClientException as exc:
+            if exc.http_status == 404:
+                if not self.index.authoritative:
+                    self.index.forget(key)
+                    return False
+                self.remote.send("CHECKPRESENT-FAILURE " + key)
+            else:
+                self.remote.send("CHECKPRESENT-UNKNOWN %s %s" % (key, str(exc)))
+        return True
+
+
     def check(self, key):
         """Check if key is present"""
+        if self.index is not None and self.check_index(key):
+            return
+
         path = self.get_path(key)
         nb_chunks = None
         chunk_idx = 0
+        incomplete = False
 
         try:
-            while path is not None:
+            chunk_path = path
+            while chunk_path is not None:
                 chunk_idx += 1
                 self.remote.debug("Checking chunk %d" % chunk_idx)
-                headers = self.conn.head_object(self.container, path)
+                headers = self.conn.head_object(self.container, chunk_path)
 
                 # Check chunk metadata
                 meta_nb_chunks = int(headers.get("x-object-meta-annex-chunks", 1))
@@ -324,11 +1335,15 @@ class SwiftConnection(object):
                 elif nb_chunks != meta_nb_chunks:
                     raise ValueError("Inconsistent number of chunks: %d != %d (%d)"
                                      % (nb_chunks, meta_nb_chunks, chunk_idx))
+                if meta_nb_chunks > 1 and "x-object-meta-annex-global-md5" not in headers:
+                    incomplete = True
 
                 # Path of the next chunk
-                path = headers.get("x-object-meta-annex-next-chunk", None)
+                chunk_path = self.next_chunk_path(path, chunk_idx - 1, headers)
 
-            if chunk_idx == nb_chunks:
+            if incomplete:
+                self.remote.send("CHECKPRESENT-FAILURE %s Incomplete upload" % key)
+            elif chunk_idx == nb_chunks:
                 self.remote.send("CHECKPRESENT-SUCCESS " + key)
             else:
                 self.remote.send("CHECKPRESENT-FAILURE %s Found %d chunks instead of %d"
@@ -343,37 +1358,164 @@ class SwiftConnection(object):
                 self.remote.send("CHECKPRESENT-UNKNOWN %s %s" % (key, str(exc)))
 
 
+    def get_capabilities(self):
+        """Get the capabilities of the Swift cluster, or an empty dict if it
+        doesn't tell"""
+        with SwiftConnection.cache_lock:
+            if SwiftConnection.capabilities is None:
+                url = urllib.parse.urlsplit(self.conn.url)
+                # A connection opened for /info would keep using this path
+                if self.conn.http_conn is None:
+                    self.conn.http_conn = self.conn.http_connection()
+                try:
+                    SwiftConnection.capabilities = self.conn.get_capabilities(
+                        "%s://%s/info" % (url.scheme, url.netloc))
+                except (ClientException, ValueError):
+                    SwiftConnection.capabilities = {}
+            return SwiftConnection.capabilities
+
+    def list_chunk_chain(self, path):
+        """Find the chunks of a file by following the links between them"""
+        chunks = []
+        chunk_path = path
+        while chunk_path is not None:
+            self.remote.debug("Checking chunk %d" % (1 + len(chunks)))
+            try:
+                headers = self.conn.head_object(self.container, chunk_path)
+            except ClientException as exc:
+                if exc.http_status == 404:
+                    break
+                else:
+                    raise exc
+            chunks.append(chunk_path)
+            if is_manifest(headers):
+                # The segments are listed in the manifest
+                _, manifest = self.conn.get_object(self.container, path,
+                                                   query_string="multipart-manifest=get")
+                chunks += [segment["name"].lstrip("/").split("/", 1)[1]
+                           for segment in json.loads(manifest.decode("utf-8"))]
+                break
+            chunk_path = self.next_chunk_path(path, len(chunks) - 1, headers)
+        return chunks
+
+    def is_stored_manifest(self, path, entry, chunks):
+        """Check if the file at path, with its listing entry and other chunks
+        or segments, is stored as a manifest. Only manifests have segments, so
+        the object is only checked when there are some."""
+        if entry is not None and "slo_etag" in entry:
+            return True
+        if not any(chunk.startswith(path + "/segment") for chunk in chunks):
+            return False
+        try:
+            return is_manifest(self.conn.head_object(self.container, path))
+        except ClientException as exc:
+            if exc.http_status == 404:
+                return False
+            raise exc
+
+    def bulk_delete(self, names):
+        """Delete objects using the bulk delete middleware, if available. Return
+        False if it is not."""
+        bulk_delete = self.get_capabilities().get("bulk_delete")
+        if bulk_delete is None:
+            return False
+        max_deletes = bulk_delete.get("max_deletes_per_request", 10000)
+
+        for start in range(0, len(names), max_deletes):
+            self.remote.debug("Removing %d objects" % len(names[start:start + max_deletes]))
+            data = "".join(urllib.parse.quote("/%s/%s" % (self.container, name)) + "\n"
+                           for name in names[start:start + max_deletes])
+            headers = {"Accept": "application/json", "Content-Type": "text/plain"}
+            _, body = self.conn.post_account(headers, query_string="bulk-delete",
+                                             data=data.encode("utf-8"))
+            if not body:
+                # No bulk delete middleware after all
+                SwiftConnection.capabilities.pop("bulk_delete", None)
+                if start == 0:
+                    return False
+                raise ValueError("Bulk delete failed: empty response")
+            errors = bulk_errors(json.loads(body.decode("utf-8")))
+            if errors:
+                raise ValueError("Bulk delete failed: %s" % ", ".join(errors))
+        return True
+
+    def remove_empty_directories(self, path):
+        """Remove the directory markers of the directories containing path that
+        are now empty, up to the root of the remote"""
+        root = self.path.strip("/")
+        path = os.path.dirname(path.strip("/"))
+        while path != root and path.startswith(root):
+            _, objects = self.conn.get_container(self.container, prefix=path + "/", limit=1)
+            if len(objects) > 0:
+                break
+            self.remote.debug("Removing empty directory '%s'" % path)
+            SwiftConnection.known_directories.discard((self.container, path))
+            if self.index is not None:
+                self.index.forget_directory(path)
+            try:
+                self.conn.delete_object(self.container, path)
+            except ClientException as exc:
+                if exc.http_status != 404:
+                    raise exc
+            path = os.path.dirname(path)
+
     def remove(self, key):
         """Remove key"""
         path = self.get_path(key)
-        chunks = []
 
-        # TODO: remove empty directories
         try:
-            # List existing chunks
-            while path is not None:
-                self.remote.debug("Checking chunk %d" % (1 + len(chunks)))
-                try:
-                    headers = self.conn.head_object(self.container, path)
-                except ClientException as exc:
-                    if exc.http_status == 404:
-                        break
-                    else:
-                        raise exc
-                chunks.append(path)
-                path = headers.get("x-object-meta-annex-next-chunk", None)
-
-            # Remove chunks. Do it in reverse order so that we can try again if
-            # this is interrupted.
-            for idx, chunk in enumerate(reversed(chunks)):
-                self.remote.debug("Removing chunk %d" % (len(chunks) - idx))
-                try:
-                    self.conn.delete_object(self.container, chunk)
-                except ClientException as exc:
-                    if exc.http_status == 404:
-                        continue
-                    else:
-                        raise exc
+            # List existing chunks or segments with a single request. Listings
+            # may lag behind, so if the file seems to be missing, make sure it
+            # really is.
+            listing = self.list_chunks(path)
+            chunks = sorted(listing)
+            if path not in chunks:
+                for chunk in self.list_chunk_chain(path):
+                    if chunk not in chunks:
+                        chunks.append(chunk)
+                chunks.sort()
+
+            found = len(chunks) > 0
+
+            # Remove the first chunk or the manifest before anything else: as
+            # long as it is there, the file is considered present, so it must
+            # not outlive the other chunks or segments. If this is interrupted,
+            # the ones left are found by the listing when trying again.
+            if path in chunks:
+                chunks.remove(path)
+                self.remote.debug("Removing object 1/%d" % (len(chunks) + 1))
+                if self.is_stored_manifest(path, listing.get(path), chunks):
+                    # Swift removes the segments along with the manifest
+                    errors = bulk_errors(self.conn.delete_manifest(self.container, path))
+                    if errors:
+                        raise ValueError("Manifest deletion failed: %s" % ", ".join(errors))
+                    # Only delete the segments it left behind
+                    chunks = sorted(chunk for chunk in self.list_chunks(path) if chunk != path)
+                else:
+                    try:
+                        self.conn.delete_object(self.container, path)
+                    except ClientException as exc:
+                        if exc.http_status != 404:
+                            raise exc
+
+            # Then the other chunks or segments
+            if chunks and not self.bulk_delete(chunks):
+                for idx, chunk in enumerate(chunks):
+                    self.remote.debug("Removing object %d/%d" % (idx + 2, len(chunks) + 1))
+                    try:
+                        self.conn.delete_object(self.container, chunk)
+                    except ClientException as exc:
+                        if exc.http_status == 404:
+                            continue
+                        else:
+                            raise exc
+
+            if self.index is not None:
+                self.index.forget(key)
+
+            # Only the "default" container has directory markers
+            if found and self.container == "default":
+                self.remove_empty_directories(path)
 
             self.remote.send("REMOVE-SUCCESS " + key)
         except KeyboardInterrupt:
@@ -0,0 +1,189 @@
+# Copyright (c) 2014-2016 Thomas Jost and the Contributors
+#
+# This file is part of git-annex-remote-hubic.
+#
+# git-annex-remote-hubic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# git-annex-remote-hubic is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# git-annex-remote-hubic. If not, see <http://www.gnu.org/licenses/>.
+
+"""Timing and request counting, to find out where time goes
+
+When GIT_ANNEX_HUBIC_TRACE_FILE is set, the remote appends to that file a JSON
+line for each span of work (a command from git-annex, a protocol round trip, a
+token refresh, a Swift request...) with its duration and counters (bytes
+transferred, HTTP requests, seconds spent hashing...), and a summary by phase
+and by key when the process exits. Counters of a span include those of the
+spans it contains, including the ones run in other threads through wrap().
+
+Otherwise, all the functions of this module do nothing."""
+
+import atexit
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+TRACE_FILE = os.getenv("GIT_ANNEX_HUBIC_TRACE_FILE")
+
+def rounded(counters):
+    """Round the times of a set of counters, for the trace file"""
+    return {name: round(value, 6) if isinstance(value, float) else value
+            for name, value in counters.items()}
+
+class Span(object):
+    """A span of work, with its counters"""
+    def __init__(self, phase, key, parent):
+        self.phase = phase
+        self.key = key
+        self.parent = parent
+        self.counters = collections.Counter()
+
+class Tracer(object):
+    """Write spans to a trace file, and sum them up by phase and by key"""
+
+    def __init__(self, filename):
+        self.file = open(filename, "a", buffering=1)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_time = time.monotonic()
+        self.totals = collections.Counter()
+        self.phases = collections.defaultdict(collections.Counter)
+        self.keys = collections.defaultdict(collections.Counter)
+        self.write({"event": "start", "argv": sys.argv})
+        atexit.register(self.close)
+
+    def write(self, event):
+        event["time"] = round(time.monotonic() - self.start_time, 6)
+        event["pid"] = os.getpid()
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(json.dumps(event, sort_keys=True) + "\n")
+
+    def current(self):
+        return getattr(self.local, "span", None)
+
+    @contextlib.contextmanager
+    def span(self, phase, key=None, **fields):
+        parent = self.current()
+        if key is None and parent is not None:
+            key = parent.key
+        new_span = self.local.span = Span(phase, key, parent)
+        error = None
+        start_time = time.monotonic()
+        try:
+            yield new_span
+        except BaseException as exc:
+            error = type(exc).__name__
+            raise
+        finally:
+            seconds = time.monotonic() - start_time
+            self.local.span = parent
+            with self.lock:
+                stats = self.phases[phase]
+                stats["count"] += 1
+                stats["seconds"] += seconds
+                stats.update(new_span.counters)
+                if key is not None and (parent is None or parent.key != key):
+                    self.keys[key]["seconds"] += seconds
+                    self.keys[key].update(new_span.counters)
+                if parent is not None:
+                    parent.counters.update(new_span.counters)
+            event = {"event": "span", "phase": phase, "key": key,
+                     "seconds": round(seconds, 6), "thread": threading.current_thread().name}
+            event.update(rounded(new_span.counters))
+            event.update(fields)
+            if error is not None:
+                event["error"] = error
+            self.write(event)
+
+    def count(self, name, value=1):
+        current = self.current()
+        with self.lock:
+            self.totals[name] += value
+            if current is not None:
+                current.counters[name] += value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.count(name, time.monotonic() - start_time)
+
+    def wrap(self, func):
+        current = self.current()
+        def _run(*args, **kwds):
+            previous = self.current()
+            self.local.span = current
+            try:
+                return func(*args, **kwds)
+            finally:
+                self.local.span = previous
+        return _run
+
+    def close(self):
+        """Write the summary"""
+        with self.lock:
+            summary = {
+                "event": "summary",
+                "seconds": round(time.monotonic() - self.start_time, 6),
+                "totals": rounded(self.totals),
+                "phases": {phase: rounded(stats) for phase, stats in self.phases.items()},
+                "keys": {key: rounded(stats) for key, stats in self.keys.items()},
+            }
+        self.write(summary)
+        with self.lock:
+            self.file.close()
+
+class NullContext(object):
+    """Context manager doing nothing, used when tracing is disabled"""
+    def __enter__(self):
+        return None
+    def __exit__(self, *args):
+        return False
+
+_null_context = NullContext()
+_tracer = Tracer(TRACE_FILE) if TRACE_FILE else None
+
+def enabled():
+    """Check if tracing is enabled"""
+    return _tracer is not None
+
+def span(phase, key=None, **fields):
+    """Context manager recording a span of work. The key defaults to the one of
+    the enclosing span; other fields are written with the span."""
+    if _tracer is None:
+        return _null_context
+    return _tracer.span(phase, key, **fields)
+
+def count(name, value=1):
+    """Add value to a counter of the current span"""
+    if _tracer is not None:
+        _tracer.count(name, value)
+
+def timer(name):
+    """Context manager adding the time it takes to a counter of the current
+    span"""
+    if _tracer is None:
+        return _null_context
+    return _tracer.timer(name)
+
+def wrap(func):
+    """Wrap func so that its spans are part of the current span, even when it
+    is called from another thread"""
+    if _tracer is None:
+        return func
+    return _tracer.wrap(func)
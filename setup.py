@@ -29,7 +29,7 @@ setup(name="git-annex-remote-hubic",
       packages=find_packages(),
       install_requires=[
           "python-dateutil",
-          "python-swiftclient>=2.1.0",
+          "python-swiftclient>=4.11.0",
           "rauth>=0.7",
       ],
       entry_points={
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# Copyright (c) 2014-2016 Thomas Jost and the Contributors
+#
+# This file is part of git-annex-remote-hubic.
+#
+# git-annex-remote-hubic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# git-annex-remote-hubic is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# git-annex-remote-hubic. If not, see <http://www.gnu.org/licenses/>.
+
+"""End-to-end transfer benchmarks
+
+The remote is run as git-annex runs it, talking the special remote protocol
+over pipes, against a local stand-in for hubiC (see fake_hubic.py). Each
+scenario stores a number of keys of a given size, checks them, retrieves them
+and removes them, measuring for each step the time spent, the throughput, the
+number of HTTP requests and of protocol messages, and the peak memory use of
+the remote.
+
+Results can be saved as JSON and compared with those of another revision:
+
+    test/benchmark.py --output before.json
+    ... (change things)
+    test/benchmark.py --compare before.json
+"""
+
+import argparse
+import collections
+import datetime
+import hashlib
+import itertools
+import json
+import os
+import os.path
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+from fake_hubic import FakeHubic
+from hubic_remote.remote import hash_dir_mixed
+
+SIZE_SUFFIXES = {"K": 2**10, "M": 2**20, "G": 2**30}
+PHASES = (
+    ("store", "TRANSFER STORE %(key)s %(src)s", "TRANSFER-SUCCESS"),
+    ("check", "CHECKPRESENT %(key)s", "CHECKPRESENT-SUCCESS"),
+    ("retrieve", "TRANSFER RETRIEVE %(key)s %(dst)s", "TRANSFER-SUCCESS"),
+    ("remove", "REMOVE %(key)s", "REMOVE-SUCCESS"),
+)
+
+
+def parse_size(size):
+    """Parse a size such as 512K, 16M or 1G"""
+    size = size.strip().upper()
+    if size[-1:] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    """Format a size with the largest suffix that divides it"""
+    for suffix, factor in sorted(SIZE_SUFFIXES.items(), key=lambda item: -item[1]):
+        if size >= factor and size % factor == 0:
+            return "%d%s" % (size // factor, suffix)
+    return str(size)
+
+
+def peak_rss(pid):
+    """Get the peak resident memory of a process, in KiB, if the system tells"""
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class AnnexDriver(object):
+    """Run the remote and answer its requests like git-annex"""
+
+    def __init__(self, api_url, config, git_dir):
+        self.config = config
+        self.git_dir = git_dir
+        self.messages = collections.Counter()
+
+        env = dict(os.environ)
+        env["GIT_ANNEX_HUBIC_API_URL"] = api_url
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT_DIR, env.get("PYTHONPATH")]))
+        env.pop("GIT_ANNEX_HUBIC_AUTH_FILE", None)
+        self.proc = subprocess.Popen([sys.executable, "-m", "hubic_remote.main"],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     env=env, universal_newlines=True, bufsize=1)
+        version = self.readline()
+        if version != "VERSION 1":
+            raise RuntimeError("Unexpected greeting from the remote: %s" % version)
+
+    def readline(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            raise RuntimeError("The remote exited unexpectedly")
+        line = line.rstrip("\n")
+        self.messages[line.split(" ", 1)[0]] += 1
+        return line
+
+    def send(self, line):
+        self.proc.stdin.write(line + "\n")
+        self.proc.stdin.flush()
+
+    def answer(self, line):
+        """Answer a request of the remote. Return False if the line is the
+        reply to the current command."""
+        parts = line.split(" ", 2)
+        if parts[0] in ("DEBUG", "PROGRESS", "SETCONFIG", "SETCREDS"):
+            pass
+        elif parts[0] == "ERROR":
+            raise RuntimeError("Remote error: %s" % line)
+        elif parts[0] == "GETCONFIG":
+            self.send("VALUE " + self.config.get(parts[1], ""))
+        elif parts[0] == "GETCREDS":
+            self.send("CREDS hubic fake-refresh-token")
+        elif parts[0] == "DIRHASH":
+            self.send("VALUE " + hash_dir_mixed(parts[1]))
+        elif parts[0] == "GETGITDIR":
+            self.send("VALUE " + self.git_dir)
+        elif parts[0] == "GETUUID":
+            self.send("VALUE bench-uuid")
+        else:
+            return False
+        return True
+
+    def request(self, line):
+        """Send a command and return the reply, answering requests meanwhile"""
+        self.send(line)
+        while True:
+            reply = self.readline()
+            if not self.answer(reply):
+                return reply
+
+    def close(self):
+        """Stop the remote, and return its peak memory use"""
+        rss = peak_rss(self.proc.pid)
+        self.proc.stdin.close()
+        self.proc.wait(timeout=60)
+        return rss
+
+
+def make_file(directory, size):
+    """Create a file of random data, and return its name and MD5 checksum"""
+    filename = os.path.join(directory, "src-%d" % size)
+    md5 = hashlib.md5()
+    with open(filename, "wb") as src:
+        remaining = size
+        while remaining > 0:
+            data = os.urandom(min(remaining, 2**20))
+            src.write(data)
+            md5.update(data)
+            remaining -= len(data)
+    return filename, md5.hexdigest()
+
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as src:
+        for data in iter(lambda: src.read(2**20), b""):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def run_scenario(server, scenario, tmp_dir):
+    """Run the four phases of a scenario with a new remote process"""
+    src, src_md5 = make_file(tmp_dir, scenario["size"])
+    dst = os.path.join(tmp_dir, "dst")
+    keys = ["SHA256E-s%d--bench%d" % (scenario["size"], idx) for idx in range(scenario["keys"])]
+
+    config = {"hubic_container": "bench"}
+    if scenario["chunk_size"] is not None:
+        config["hubic_chunk_size"] = str(scenario["chunk_size"])
+    config.update(scenario["config"])
+    annex = AnnexDriver(server.url, config, tempfile.mkdtemp(dir=tmp_dir))
+    reply = annex.request("PREPARE")
+    if reply != "PREPARE-SUCCESS":
+        raise RuntimeError(reply)
+
+    phases = []
+    for name, command, success in PHASES:
+        server.reset_counts()
+        annex.messages.clear()
+        seconds = 0.0
+        failures = 0
+        for key in keys:
+            start = time.monotonic()
+            reply = annex.request(command % {"key": key, "src": src, "dst": dst})
+            seconds += time.monotonic() - start
+            if not reply.startswith(success):
+                failures += 1
+            if name == "retrieve" and os.path.exists(dst):
+                if file_md5(dst) != src_md5:
+                    failures += 1
+                os.remove(dst)
+        stats = server.stats()
+        nb_bytes = scenario["size"] * len(keys) if name in ("store", "retrieve") else 0
+        phases.append({
+            "phase": name,
+            "seconds": seconds,
+            "mb_per_s": nb_bytes / 2**20 / seconds if nb_bytes and seconds else None,
+            "requests": stats["requests"],
+            "requests_by_type": stats["requests_by_type"],
+            "messages": sum(annex.messages.values()),
+            "messages_by_type": dict(annex.messages),
+            "failures": failures,
+        })
+
+    rss = annex.close()
+    os.remove(src)
+    return {"scenario": scenario, "phases": phases, "peak_rss_kb": rss}
+
+
+def scenario_id(scenario):
+    """Name a scenario, to match it between result files"""
+    parts = ["size=%s" % format_size(scenario["size"]),
+             "chunk=%s" % ("default" if scenario["chunk_size"] is None
+                           else format_size(scenario["chunk_size"])),
+             "keys=%d" % scenario["keys"]]
+    parts += ["%s=%s" % item for item in sorted(scenario["config"].items())]
+    return " ".join(parts)
+
+
+def median_run(runs):
+    """Keep the run whose total time is the median one"""
+    runs = sorted(runs, key=lambda run: sum(phase["seconds"] for phase in run["phases"]))
+    return runs[(len(runs) - 1) // 2]
+
+
+def revision():
+    """Describe the revision being benchmarked"""
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=ROOT_DIR,
+                                       universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print("%-48s %-8s %9s %9s %9s %9s %10s" % ("scenario", "phase", "seconds", "MB/s",
+                                              "requests", "messages", "peak RSS"))
+    for result in results:
+        for idx, phase in enumerate(result["phases"]):
+            print("%-48s %-8s %9.3f %9s %9d %9d %10s" % (
+                scenario_id(result["scenario"]) if idx == 0 else "", phase["phase"],
+                phase["seconds"],
+                "-" if phase["mb_per_s"] is None else "%.1f" % phase["mb_per_s"],
+                phase["requests"], phase["messages"],
+                "%d KiB" % result["peak_rss_kb"] if idx == 0 and result["peak_rss_kb"] else ""))
+            if phase["failures"]:
+                print("    %d failure(s)!" % phase["failures"])
+
+
+def compare_results(old, new):
+    """Print the changes between two result sets"""
+    old_results = {scenario_id(result["scenario"]): result for result in old["results"]}
+    print("Comparing %s (old) with %s (new)" % (old.get("revision"), new.get("revision")))
+
+    def _change(old_value, new_value):
+        if old_value is None or new_value is None:
+            return "%10s -> %-10s" % (old_value, new_value)
+        if old_value == 0:
+            return "%10.4g -> %-10.4g" % (old_value, new_value)
+        return "%10.4g -> %-10.4g (%+.1f%%)" % (old_value, new_value,
+                                                 100.0 * (new_value - old_value) / old_value)
+
+    for result in new["results"]:
+        name = scenario_id(result["scenario"])
+        if name not in old_results:
+            print("%s: not in the old results" % name)
+            continue
+        print(name)
+        old_phases = {phase["phase"]: phase for phase in old_results[name]["phases"]}
+        for phase in result["phases"]:
+            old_phase = old_phases.get(phase["phase"])
+            if old_phase is None:
+                continue
+            for metric in ("seconds", "mb_per_s", "requests", "messages"):
+                if old_phase[metric] is None and phase[metric] is None:
+                    continue
+                print("  %-8s %-9s %s" % (phase["phase"], metric,
+                                          _change(old_phase[metric], phase[metric])))
+        print("  %-18s %s" % ("peak RSS (KiB)", _change(old_results[name]["peak_rss_kb"],
+                                                         result["peak_rss_kb"])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hubiC remote against a local "
+                                     "stand-in for hubiC")
+    parser.add_argument("--sizes", default="1M,16M,128M",
+                        help="comma-separated file sizes (default: %(default)s)")
+    parser.add_argument("--chunk-sizes", default="default,8M",
+                        help="comma-separated chunk sizes, \"default\" for the remote's own "
+                        "(default: %(default)s)")
+    parser.add_argument("--keys", default="1,20",
+                        help="comma-separated numbers of keys per scenario (default: %(default)s)")
+    parser.add_argument("--config", action="append", default=[], metavar="NAME=VALUE",
+                        help="remote setting used in every scenario, may be repeated")
+    parser.add_argument("--max-data", default="512M",
+                        help="skip scenarios moving more data than this (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="run each scenario this many times and keep the median run")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="delay added by the server to every request, in seconds")
+    parser.add_argument("--bandwidth", type=parse_size,
+                        help="bandwidth cap of the server, in bytes/s (e.g. 10M)")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with those of this JSON file")
+    args = parser.parse_args()
+
+    config = dict(item.split("=", 1) for item in args.config)
+    chunk_sizes = [None if chunk_size.strip() == "default" else parse_size(chunk_size)
+                   for chunk_size in args.chunk_sizes.split(",")]
+    scenarios = []
+    for size, chunk_size, keys in itertools.product(
+            [parse_size(size) for size in args.sizes.split(",")], chunk_sizes,
+            [int(keys) for keys in args.keys.split(",")]):
+        if size * keys <= parse_size(args.max_data):
+            scenarios.append({"size": size, "chunk_size": chunk_size, "keys": keys,
+                              "config": config})
+
+    results = []
+    with FakeHubic(latency=args.latency, bandwidth=args.bandwidth) as server, \
+         tempfile.TemporaryDirectory(prefix="hubic-bench-") as tmp_dir:
+        server.containers["bench"] = {}
+        for scenario in scenarios:
+            print("Running %s..." % scenario_id(scenario), file=sys.stderr, flush=True)
+            runs = [run_scenario(server, scenario, tmp_dir) for _ in range(max(1, args.repeat))]
+            results.append(median_run(runs))
+
+    output = {
+        "revision": revision(),
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "latency": args.latency,
+            "bandwidth": args.bandwidth,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(output, out, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as old:
+            print()
+            compare_results(json.load(old), output)
+    if any(phase["failures"] for result in results for phase in result["phases"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
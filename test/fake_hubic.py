@@ -0,0 +1,658 @@
+# Copyright (c) 2014-2016 Thomas Jost and the Contributors
+#
+# This file is part of git-annex-remote-hubic.
+#
+# git-annex-remote-hubic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# git-annex-remote-hubic is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# git-annex-remote-hubic. If not, see <http://www.gnu.org/licenses/>.
+
+"""Local stand-in for the hubiC API and its Swift storage
+
+This implements the subset of the hubiC OAuth API and of the OpenStack Swift API
+used by this package, so that the remote can be tested and benchmarked without
+a hubiC account. Point the remote to it with GIT_ANNEX_HUBIC_API_URL, and use
+"fake-refresh-token" as the OAuth refresh token.
+
+Run it as a script, or start a FakeHubic in the tests process to inject errors,
+expire tokens and count requests.
+"""
+
+import argparse
+import collections
+import datetime
+import email.utils
+import hashlib
+import http.server
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+import dateutil.tz
+
+ACCOUNT = "AUTH_fake"
+BLOCK_SIZE = 65536
+
+
+def http_date(timestamp):
+    """Format a timestamp for a Last-Modified header"""
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+class FakeObject(object):
+    """A Swift object stored in memory"""
+    def __init__(self, data, content_type, meta, manifest=None):
+        self.data = data
+        self.content_type = content_type
+        self.meta = meta
+        self.manifest = manifest
+        self.timestamp = time.time()
+        if manifest is None:
+            self.etag = hashlib.md5(data).hexdigest()
+            self.size = len(data)
+        else:
+            etags = "".join(seg["etag"] for seg in manifest)
+            self.etag = hashlib.md5(etags.encode()).hexdigest()
+            self.size = sum(seg["size_bytes"] for seg in manifest)
+
+
+class FakeHubic(object):
+    """In-process hubiC server: OAuth API, account credentials and Swift storage"""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, bandwidth=None,
+                 token_lifetime=86400, access_token_lifetime=3600, error_rate=0.0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.token_lifetime = token_lifetime
+        self.access_token_lifetime = access_token_lifetime
+
+        self.lock = threading.RLock()
+        self.containers = {"default": {}}
+        self.refresh_tokens = {"fake-refresh-token"}
+        self.access_tokens = {}
+        self.swift_tokens = {}
+        self.failures = []
+        self.counts = collections.Counter()
+        # Limits of Static Large Objects, as advertised by /info (None if they
+        # are not supported)
+        self.slo = {"max_manifest_segments": 1000}
+        self.bytes_in = self.bytes_out = 0
+
+        self.httpd = FakeHTTPServer((host, port), FakeHandler)
+        self.httpd.hubic = self
+        self.thread = None
+
+    # Lifecycle
+    @property
+    def url(self):
+        """Base URL of the server"""
+        host, port = self.httpd.server_address[:2]
+        return "http://%s:%d/" % (host, port)
+
+    @property
+    def storage_url(self):
+        """Swift storage URL, as returned by account/credentials"""
+        return self.url + "v1/" + ACCOUNT
+
+    def start(self):
+        """Serve requests in a background thread"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving requests"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # Test helpers
+    def inject(self, status, method=None, path=None, count=1):
+        """Make the next `count` matching Swift requests fail with `status`"""
+        with self.lock:
+            self.failures.append({"status": status, "method": method,
+                                  "path": path, "count": count})
+
+    def cut(self, after, method="GET", path=None, count=1):
+        """Make the next `count` matching Swift requests drop the connection
+        after sending `after` bytes of the response body"""
+        with self.lock:
+            self.failures.append({"status": None, "cut": after, "method": method,
+                                  "path": path, "count": count})
+
+    def expire_tokens(self):
+        """Expire every OpenStack token handed out so far"""
+        with self.lock:
+            for token in self.swift_tokens:
+                self.swift_tokens[token] = 0
+
+    def reset_counts(self):
+        """Reset request and byte counters"""
+        with self.lock:
+            self.counts.clear()
+            self.bytes_in = self.bytes_out = 0
+
+    def stats(self):
+        """Request and byte counters, as a plain dict"""
+        with self.lock:
+            return {
+                "requests": sum(self.counts.values()),
+                "requests_by_type": dict(self.counts),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
+
+    def objects(self, container):
+        """Names of the objects stored in a container"""
+        with self.lock:
+            return sorted(self.containers.get(container, {}))
+
+    def get_object(self, container, name):
+        """Get a stored object"""
+        with self.lock:
+            return self.containers[container][name]
+
+    def delete_object(self, container, name):
+        """Delete a stored object behind the client's back"""
+        with self.lock:
+            del self.containers[container][name]
+
+    def take_failure(self, method, path):
+        """Return an injected failure matching this request, if any"""
+        if self.error_rate and random.random() < self.error_rate:
+            return {"status": 503}
+        with self.lock:
+            for failure in self.failures:
+                if failure["method"] not in (None, method):
+                    continue
+                if failure["path"] is not None and failure["path"] not in path:
+                    continue
+                failure["count"] -= 1
+                if failure["count"] <= 0:
+                    self.failures.remove(failure)
+                return failure
+        return None
+
+    # OAuth and credentials
+    def new_access_token(self, refresh_token):
+        """Issue an OAuth access token"""
+        if refresh_token not in self.refresh_tokens:
+            return None
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.access_tokens[token] = time.time() + self.access_token_lifetime
+        return {
+            "access_token": token,
+            "refresh_token": refresh_token,
+            "expires_in": self.access_token_lifetime,
+            "token_type": "Bearer",
+        }
+
+    def new_swift_credentials(self, access_token):
+        """Issue an OpenStack token"""
+        with self.lock:
+            if self.access_tokens.get(access_token, 0) <= time.time():
+                return None
+            token = uuid.uuid4().hex
+            expires = time.time() + self.token_lifetime
+            self.swift_tokens[token] = expires
+        expires = datetime.datetime.fromtimestamp(expires, dateutil.tz.tzlocal())
+        return {
+            "token": token,
+            "endpoint": self.storage_url,
+            "expires": expires.isoformat(),
+        }
+
+    def swift_token_valid(self, token):
+        """Check an OpenStack token"""
+        with self.lock:
+            return self.swift_tokens.get(token, 0) > time.time()
+
+
+class FakeHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Threaded HTTP server"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler for the fake hubiC server"""
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent separately: don't wait for an ACK in between
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args, **kwargs):
+        """No-op log message handler"""
+        pass
+
+    @property
+    def hubic(self):
+        return self.server.hubic
+
+    # Low-level helpers
+    def throttle(self, size):
+        """Sleep as needed to honour the bandwidth cap"""
+        if self.hubic.bandwidth:
+            time.sleep(size / self.hubic.bandwidth)
+
+    def read_body(self):
+        """Read the request body, plain or chunked"""
+        data = bytearray()
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                data += self.rfile.read(size)
+                self.rfile.readline()
+                self.throttle(size)
+        else:
+            remaining = int(self.headers.get("Content-Length", 0))
+            while remaining > 0:
+                block = self.rfile.read(min(remaining, BLOCK_SIZE))
+                if not block:
+                    break
+                data += block
+                remaining -= len(block)
+                self.throttle(len(block))
+        with self.hubic.lock:
+            self.hubic.bytes_in += len(data)
+        return bytes(data)
+
+    def reply(self, status, body=b"", headers=None, head=False):
+        """Send a complete response"""
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        headers = dict(headers or {})
+        headers.setdefault("Content-Length", str(len(body)))
+        headers.setdefault("X-Trans-Id", uuid.uuid4().hex)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if head or self.command == "HEAD":
+            return
+        if getattr(self, "cut_after", None) is not None:
+            body = body[:self.cut_after]
+            self.close_connection = True
+        for pos in range(0, len(body), BLOCK_SIZE):
+            block = body[pos:pos + BLOCK_SIZE]
+            self.wfile.write(block)
+            self.throttle(len(block))
+        with self.hubic.lock:
+            self.hubic.bytes_out += len(body)
+
+    def reply_json(self, status, obj):
+        self.reply(status, json.dumps(obj), {"Content-Type": "application/json; charset=utf-8"})
+
+    # Dispatch
+    def handle_any(self):
+        if self.hubic.latency:
+            time.sleep(self.hubic.latency)
+
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        parts = url.path.lstrip("/").split("/", 3)
+
+        if url.path.startswith("/oauth/") or url.path.startswith("/1.0/"):
+            return self.handle_api(url.path, query)
+        if url.path == "/info":
+            info = {"swift": {"version": "fake"}, "bulk_delete": {}}
+            if self.hubic.slo is not None:
+                info["slo"] = self.hubic.slo
+            return self.reply_json(200, info)
+        if len(parts) < 2 or parts[0] != "v1" or parts[1] != ACCOUNT:
+            return self.reply(404)
+
+        container = urllib.parse.unquote(parts[2]) if len(parts) > 2 and parts[2] else None
+        name = urllib.parse.unquote(parts[3]) if len(parts) > 3 and parts[3] else None
+        kind = "object" if name else ("container" if container else "account")
+        with self.hubic.lock:
+            self.hubic.counts["%s %s" % (self.command, kind)] += 1
+
+        failure = self.hubic.take_failure(self.command, url.path) or {}
+        self.cut_after = failure.get("cut")
+        status = failure.get("status")
+        if status is None and not self.hubic.swift_token_valid(self.headers.get("X-Auth-Token")):
+            status = 401
+        if status is not None:
+            self.read_body()
+            return self.reply(status, "Injected failure" if status != 401 else "Unauthorized")
+
+        handler = getattr(self, "swift_%s_%s" % (self.command.lower(), kind), None)
+        if handler is None:
+            self.read_body()
+            return self.reply(405)
+        if kind == "object":
+            return handler(container, name, query)
+        elif kind == "container":
+            return handler(container, query)
+        return handler(query)
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = handle_any
+
+    # hubiC API
+    def handle_api(self, path, query):
+        with self.hubic.lock:
+            self.hubic.counts["%s api" % self.command] += 1
+        body = self.read_body()
+        if path == "/oauth/token" and self.command == "POST":
+            form = dict(urllib.parse.parse_qsl(body.decode()))
+            form.update(query)
+            token = form.get("refresh_token")
+            if form.get("grant_type") == "authorization_code":
+                token = "fake-refresh-token"
+            tokens = self.hubic.new_access_token(token)
+            if tokens is None:
+                return self.reply_json(401, {"error": "invalid_grant"})
+            return self.reply_json(200, tokens)
+        if path == "/1.0/account/credentials" and self.command == "GET":
+            auth = self.headers.get("Authorization", "")
+            access_token = auth.split(None, 1)[-1] if auth else query.get("access_token")
+            creds = self.hubic.new_swift_credentials(access_token)
+            if creds is None:
+                return self.reply_json(401, {"error": "invalid_token"})
+            return self.reply_json(200, creds)
+        return self.reply(404)
+
+    # Swift helpers
+    def container(self, container):
+        return self.hubic.containers.get(container)
+
+    def request_meta(self):
+        return {name.lower(): value for name, value in self.headers.items()
+                if name.lower().startswith("x-object-meta-")}
+
+    def object_headers(self, obj):
+        headers = {
+            "Content-Type": obj.content_type,
+            "Etag": obj.etag if obj.manifest is None else '"%s"' % obj.etag,
+            "Last-Modified": http_date(obj.timestamp),
+            "X-Timestamp": "%.5f" % obj.timestamp,
+            "Accept-Ranges": "bytes",
+        }
+        if obj.manifest is not None:
+            headers["X-Static-Large-Object"] = "True"
+        headers.update(obj.meta)
+        return headers
+
+    def object_data(self, obj):
+        """Data of an object, or None if it is a manifest with missing segments"""
+        if obj.manifest is None:
+            return obj.data
+        data = bytearray()
+        for seg in obj.manifest:
+            container, name = seg["path"].lstrip("/").split("/", 1)
+            segment = (self.container(container) or {}).get(name)
+            if segment is None:
+                return None
+            data += segment.data
+        return bytes(data)
+
+    # Swift account
+    def swift_head_account(self, query):
+        self.reply(204, headers={"X-Account-Container-Count": str(len(self.hubic.containers))})
+
+    def swift_get_account(self, query):
+        with self.hubic.lock:
+            listing = [{"name": name, "count": len(objs),
+                        "bytes": sum(obj.size for obj in objs.values())}
+                       for name, objs in sorted(self.hubic.containers.items())]
+        self.reply_json(200, listing)
+
+    def swift_post_account(self, query):
+        body = self.read_body()
+        if "bulk-delete" not in query:
+            return self.reply(204)
+        deleted = not_found = 0
+        with self.hubic.lock:
+            for line in body.decode().splitlines():
+                line = urllib.parse.unquote(line.strip()).lstrip("/")
+                if not line:
+                    continue
+                container, _, name = line.partition("/")
+                objs = self.container(container)
+                if objs is not None and name in objs:
+                    del objs[name]
+                    deleted += 1
+                else:
+                    not_found += 1
+        self.reply_json(200, {"Number Deleted": deleted, "Number Not Found": not_found,
+                              "Errors": [], "Response Status": "200 OK", "Response Body": ""})
+
+    # Swift containers
+    def swift_head_container(self, container, query):
+        objs = self.container(container)
+        if objs is None:
+            return self.reply(404)
+        self.reply(204, headers={"X-Container-Object-Count": str(len(objs)),
+                                 "X-Container-Bytes-Used": str(sum(o.size for o in objs.values()))})
+
+    def swift_put_container(self, container, query):
+        self.read_body()
+        with self.hubic.lock:
+            created = container not in self.hubic.containers
+            self.hubic.containers.setdefault(container, {})
+        self.reply(201 if created else 202)
+
+    def swift_delete_container(self, container, query):
+        with self.hubic.lock:
+            objs = self.container(container)
+            if objs is None:
+                return self.reply(404)
+            if objs:
+                return self.reply(409)
+            del self.hubic.containers[container]
+        self.reply(204)
+
+    def swift_get_container(self, container, query):
+        prefix = query.get("prefix", "")
+        marker = query.get("marker", "")
+        end_marker = query.get("end_marker")
+        delimiter = query.get("delimiter")
+        limit = int(query.get("limit", 10000))
+        with self.hubic.lock:
+            objs = self.container(container)
+            if objs is None:
+                return self.reply(404)
+            names = sorted(name for name in objs if name.startswith(prefix) and name > marker
+                           and (end_marker is None or name < end_marker))
+            listing = []
+            seen_subdirs = set()
+            for name in names:
+                if len(listing) >= limit:
+                    break
+                if delimiter:
+                    idx = name.find(delimiter, len(prefix))
+                    if idx >= 0:
+                        subdir = name[:idx + 1]
+                        if subdir not in seen_subdirs:
+                            seen_subdirs.add(subdir)
+                            listing.append({"subdir": subdir})
+                        continue
+                obj = objs[name]
+                listing.append({
+                    "name": name,
+                    "hash": obj.etag,
+                    "bytes": obj.size,
+                    "content_type": obj.content_type,
+                    "last_modified": datetime.datetime.utcfromtimestamp(obj.timestamp).isoformat(),
+                })
+        self.reply_json(200, listing)
+
+    # Swift objects
+    def swift_head_object(self, container, name, query):
+        self.swift_get_object(container, name, query, head=True)
+
+    def swift_get_object(self, container, name, query, head=False):
+        with self.hubic.lock:
+            objs = self.container(container)
+            obj = objs.get(name) if objs is not None else None
+            if obj is None:
+                return self.reply(404, head=head)
+            headers = self.object_headers(obj)
+            if obj.manifest is not None and query.get("multipart-manifest") == "get":
+                data = json.dumps([{"name": seg["path"], "hash": seg["etag"],
+                                    "bytes": seg["size_bytes"]}
+                                   for seg in obj.manifest]).encode()
+                headers["Content-Type"] = "application/json; charset=utf-8"
+            elif head:
+                headers["Content-Length"] = str(obj.size)
+                return self.reply(200, headers=headers, head=True)
+            else:
+                data = self.object_data(obj)
+                if data is None:
+                    return self.reply(409, "Missing SLO segment")
+
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            start, _, end = range_header[6:].split(",")[0].partition("-")
+            if start == "":
+                start, end = max(0, len(data) - int(end)), len(data) - 1
+            else:
+                start, end = int(start), int(end) if end else len(data) - 1
+            end = min(end, len(data) - 1)
+            if start >= len(data):
+                return self.reply(416, headers={"Content-Range": "bytes */%d" % len(data)})
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(data))
+            return self.reply(206, data[start:end + 1], headers)
+        self.reply(200, data, headers)
+
+    def swift_put_object(self, container, name, query):
+        body = self.read_body()
+        with self.hubic.lock:
+            objs = self.container(container)
+            if objs is None:
+                return self.reply(404)
+            meta = self.request_meta()
+            content_type = self.headers.get("Content-Type") or "application/octet-stream"
+            copy_from = self.headers.get("X-Copy-From")
+            if copy_from is not None:
+                src_path = urllib.parse.unquote(copy_from).lstrip("/")
+                src_container, _, src_name = src_path.partition("/")
+                src = (self.container(src_container) or {}).get(src_name)
+                if src is None:
+                    return self.reply(404)
+                src_meta = dict(src.meta)
+                src_meta.update(meta)
+                data = self.object_data(src)
+                if data is None:
+                    return self.reply(409, "Missing SLO segment")
+                obj = FakeObject(data, src.content_type, src_meta)
+            elif query.get("multipart-manifest") == "put":
+                segments = json.loads(body.decode())
+                if self.hubic.slo is None:
+                    return self.reply(400, "Static Large Objects are not supported")
+                if len(segments) > self.hubic.slo.get("max_manifest_segments", 1000):
+                    return self.reply(400, "Too many segments")
+                manifest = []
+                for idx, seg in enumerate(segments):
+                    seg_container, _, seg_name = seg["path"].lstrip("/").partition("/")
+                    seg_obj = (self.container(seg_container) or {}).get(seg_name)
+                    if seg_obj is None or seg_obj.manifest is not None \
+                       or (seg.get("etag") and seg["etag"] != seg_obj.etag) \
+                       or (seg.get("size_bytes") and seg["size_bytes"] != seg_obj.size):
+                        return self.reply(400, "Invalid SLO segment " + seg["path"])
+                    # Older versions of Swift only accept small segments at the end
+                    if idx < len(segments) - 1 \
+                       and seg_obj.size < self.hubic.slo.get("min_segment_size", 1):
+                        return self.reply(400, "Too small SLO segment " + seg["path"])
+                    manifest.append({"path": "/%s/%s" % (seg_container, seg_name),
+                                     "etag": seg_obj.etag, "size_bytes": seg_obj.size})
+                obj = FakeObject(b"", content_type, meta, manifest)
+            else:
+                obj = FakeObject(body, content_type, meta)
+                etag = self.headers.get("Etag")
+                if etag and etag.strip('"') != obj.etag:
+                    return self.reply(422, "Unprocessable Entity")
+            objs[name] = obj
+        self.reply(201, headers={"Etag": obj.etag, "Last-Modified": http_date(obj.timestamp)})
+
+    def swift_post_object(self, container, name, query):
+        self.read_body()
+        with self.hubic.lock:
+            obj = (self.container(container) or {}).get(name)
+            if obj is None:
+                return self.reply(404)
+            obj.meta = self.request_meta()
+            if self.headers.get("Content-Type"):
+                obj.content_type = self.headers["Content-Type"]
+        self.reply(202)
+
+    def swift_delete_object(self, container, name, query):
+        self.read_body()
+        with self.hubic.lock:
+            objs = self.container(container)
+            obj = objs.get(name) if objs is not None else None
+            if obj is None:
+                return self.reply(404)
+            if query.get("multipart-manifest") != "delete":
+                del objs[name]
+                return self.reply(204)
+
+            # Like Swift, report the result of a manifest deletion in the body
+            # of a 200 response, even when it fails
+            if obj.manifest is None:
+                return self.reply_json(200, {
+                    "Number Deleted": 0, "Number Not Found": 0,
+                    "Errors": [["/%s/%s" % (container, name), "Not an SLO manifest"]],
+                    "Response Status": "400 Bad Request", "Response Body": ""})
+            deleted = not_found = 0
+            for seg in obj.manifest:
+                seg_container, _, seg_name = seg["path"].lstrip("/").partition("/")
+                if (self.container(seg_container) or {}).pop(seg_name, None) is None:
+                    not_found += 1
+                else:
+                    deleted += 1
+            del objs[name]
+        self.reply_json(200, {"Number Deleted": deleted + 1, "Number Not Found": not_found,
+                              "Errors": [], "Response Status": "200 OK", "Response Body": ""})
+
+
+def main():
+    """Run a fake hubiC server in the foreground"""
+    parser = argparse.ArgumentParser(description="Run a local stand-in for hubiC")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=18182, help="port to listen on")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="delay added to every request, in seconds")
+    parser.add_argument("--bandwidth", type=float,
+                        help="bandwidth cap for request and response bodies, in bytes/s")
+    parser.add_argument("--token-lifetime", type=int, default=86400,
+                        help="lifetime of the OpenStack tokens, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of Swift requests that fail with a 503 error")
+    args = parser.parse_args()
+
+    server = FakeHubic(args.host, args.port, latency=args.latency, bandwidth=args.bandwidth,
+                       token_lifetime=args.token_lifetime, error_rate=args.error_rate)
+    print("export GIT_ANNEX_HUBIC_API_URL=%s" % server.url)
+    print("Refresh token: fake-refresh-token", file=sys.stderr)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
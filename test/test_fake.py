@@ -0,0 +1,428 @@
+# Copyright (c) 2014-2016 Thomas Jost and the Contributors
+#
+# This file is part of git-annex-remote-hubic.
+#
+# git-annex-remote-hubic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# git-annex-remote-hubic is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# git-annex-remote-hubic. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the remote against the local stand-in for hubiC
+
+The remote is driven through the special remote protocol, like in
+test/benchmark.py, while the stand-in injects errors, cuts connections and
+expires tokens. Run them with test/run --fake, or with:
+
+    python3 -m unittest discover -s test
+"""
+
+import contextlib
+import functools
+import io
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark import AnnexDriver, file_md5, make_file
+from fake_hubic import FakeHubic
+
+from hubic_remote import auth, index, migrate, resync
+
+CONTAINER = "test"
+
+
+class JobDriver(AnnexDriver):
+    """Driver that can also talk to the remote with the ASYNC extension"""
+    job = None
+
+    def send(self, line):
+        if self.job is not None:
+            line = "J %s %s" % (self.job, line)
+        super().send(line)
+
+    def run_jobs(self, commands):
+        """Send commands as concurrent jobs, numbered from 1, answer their
+        requests and return their replies"""
+        for number, command in enumerate(commands, 1):
+            self.job = str(number)
+            self.send(command)
+        replies = {}
+        while len(replies) < len(commands):
+            prefix, number, line = self.readline().split(" ", 2)
+            if prefix != "J":
+                raise RuntimeError("Message outside of a job: %s %s %s" % (prefix, number, line))
+            self.job = number
+            if not self.answer(line):
+                replies[number] = line
+        self.job = None
+        return [replies[str(number)] for number in range(1, len(commands) + 1)]
+
+
+class FakeHubicTestCase(unittest.TestCase):
+    """Start a stand-in for hubiC and a remote using it for each test"""
+    config = {}
+
+    def setUp(self):
+        self.server = FakeHubic().start()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.git_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        self.annexes = []
+        self.annex = self.start_remote()
+
+    def tearDown(self):
+        for annex in self.annexes:
+            annex.proc.kill()
+            annex.proc.wait()
+            annex.proc.stdout.close()
+            annex.proc.stdin.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def start_remote(self, git_dir=None, prepare=True, **config):
+        """Start a remote, with 1000-byte chunks unless told otherwise"""
+        full_config = {"hubic_container": CONTAINER, "hubic_chunk_size": "1000"}
+        full_config.update(self.config)
+        full_config.update(config)
+        annex = JobDriver(self.server.url, full_config, git_dir or self.git_dir)
+        self.annexes.append(annex)
+        if prepare:
+            self.assertEqual(annex.request("PREPARE"), "PREPARE-SUCCESS")
+        return annex
+
+    def make_file(self, size):
+        """Create a file of random data: return its key, name and checksum"""
+        directory = tempfile.mkdtemp(dir=self.tmp_dir)
+        filename, md5 = make_file(directory, size)
+        return "SHA256E-s%d--%s" % (size, md5), filename, md5
+
+    def assertReply(self, reply, expected):
+        self.assertTrue(reply.startswith(expected + " ") or reply == expected,
+                        "%r instead of %s" % (reply, expected))
+
+    def store(self, key, filename, annex=None):
+        reply = (annex or self.annex).request("TRANSFER STORE %s %s" % (key, filename))
+        self.assertReply(reply, "TRANSFER-SUCCESS")
+
+    def retrieve(self, key, md5, annex=None):
+        dst = os.path.join(self.tmp_dir, "dst")
+        reply = (annex or self.annex).request("TRANSFER RETRIEVE %s %s" % (key, dst))
+        self.assertReply(reply, "TRANSFER-SUCCESS")
+        self.assertEqual(file_md5(dst), md5)
+        os.remove(dst)
+
+    def check(self, key, expected, annex=None):
+        self.assertReply((annex or self.annex).request("CHECKPRESENT " + key), expected)
+
+    def remove(self, key, annex=None):
+        self.assertReply((annex or self.annex).request("REMOVE " + key), "REMOVE-SUCCESS")
+
+    def requests(self):
+        """Requests made since the counters were last reset"""
+        return self.server.stats()["requests_by_type"]
+
+
+class TransferTests(FakeHubicTestCase):
+    """Store, check, retrieve and remove files"""
+
+    def test_round_trip(self):
+        for size in (0, 500, 3500):
+            key, filename, md5 = self.make_file(size)
+            self.store(key, filename)
+            self.check(key, "CHECKPRESENT-SUCCESS")
+            self.retrieve(key, md5)
+            self.remove(key)
+            self.check(key, "CHECKPRESENT-FAILURE")
+        self.assertEqual(self.server.objects(CONTAINER), [])
+
+    def test_server_errors_are_retried(self):
+        key, filename, md5 = self.make_file(3500)
+        self.server.inject(503, "PUT", count=2)
+        self.store(key, filename)
+        self.server.inject(503, "GET", count=2)
+        self.retrieve(key, md5)
+
+    def test_expired_token_is_renewed(self):
+        key, filename, md5 = self.make_file(3500)
+        self.store(key, filename)
+        self.server.expire_tokens()
+        self.server.reset_counts()
+        self.retrieve(key, md5)
+        self.assertEqual(self.requests().get("GET api"), 1)
+
+    def test_corrupted_chunk(self):
+        key, filename, md5 = self.make_file(3500)
+        self.store(key, filename)
+        # Data altered on the server, which still has the original ETag
+        obj = self.server.get_object(CONTAINER, key + "/chunk0002")
+        data, obj.data = obj.data, bytes([obj.data[0] ^ 1]) + obj.data[1:]
+        dst = os.path.join(self.tmp_dir, "dst")
+        reply = self.annex.request("TRANSFER RETRIEVE %s %s" % (key, dst))
+        self.assertReply(reply, "TRANSFER-FAILURE")
+        self.assertFalse(os.path.exists(dst))
+        obj.data = data
+        self.retrieve(key, md5)
+
+    def test_parallel_transfers(self):
+        annex = self.start_remote(hubic_upload_concurrency="3",
+                                  hubic_download_concurrency="3")
+        key, filename, md5 = self.make_file(9500)
+        self.store(key, filename, annex)
+        self.check(key, "CHECKPRESENT-SUCCESS", annex)
+        self.retrieve(key, md5, annex)
+
+    def test_resume_upload(self):
+        key, filename, md5 = self.make_file(5000)
+        self.server.inject(400, "PUT", "chunk0003")
+        reply = self.annex.request("TRANSFER STORE %s %s" % (key, filename))
+        self.assertReply(reply, "TRANSFER-FAILURE")
+        self.check(key, "CHECKPRESENT-FAILURE")
+
+        # The chunks already stored are not sent again
+        self.server.reset_counts()
+        self.store(key, filename)
+        self.assertLess(self.requests()["PUT object"], 5)
+        self.retrieve(key, md5)
+
+    def test_resume_download(self):
+        key, filename, md5 = self.make_file(5000)
+        self.store(key, filename)
+        dst = os.path.join(self.tmp_dir, "dst")
+        self.server.cut(100, path="chunk0003")
+        self.server.inject(404, "GET", "chunk0003")
+        reply = self.annex.request("TRANSFER RETRIEVE %s %s" % (key, dst))
+        self.assertReply(reply, "TRANSFER-FAILURE")
+
+        # The chunks already received are not downloaded again
+        self.server.reset_counts()
+        self.retrieve(key, md5)
+        self.assertLess(self.server.stats()["bytes_out"], 5000)
+
+
+class AsyncTests(FakeHubicTestCase):
+    """Concurrent jobs with the ASYNC extension"""
+
+    def setUp(self):
+        super().setUp()
+        self.annex = self.start_remote(prepare=False)
+
+    def test_jobs(self):
+        self.assertEqual(self.annex.request("EXTENSIONS ASYNC"), "EXTENSIONS ASYNC")
+        files = [self.make_file(size) for size in (2500, 3500)]
+        for reply in self.annex.run_jobs(["PREPARE"] * 2):
+            self.assertEqual(reply, "PREPARE-SUCCESS")
+        for reply in self.annex.run_jobs(["TRANSFER STORE %s %s" % (key, filename)
+                                          for key, filename, _ in files]):
+            self.assertReply(reply, "TRANSFER-SUCCESS")
+        for reply in self.annex.run_jobs(["CHECKPRESENT " + key for key, _, _ in files]):
+            self.assertReply(reply, "CHECKPRESENT-SUCCESS")
+        for key, _, md5 in files:
+            self.retrieve(key, md5)
+
+
+class SLOTests(FakeHubicTestCase):
+    """Files stored as Static Large Objects"""
+    config = {"hubic_storage_format": "slo"}
+
+    def test_round_trip(self):
+        key, filename, md5 = self.make_file(3500)
+        self.store(key, filename)
+        self.assertIsNotNone(self.server.get_object(CONTAINER, key).manifest)
+        self.check(key, "CHECKPRESENT-SUCCESS")
+        self.retrieve(key, md5)
+        self.remove(key)
+        self.assertEqual(self.server.objects(CONTAINER), [])
+
+    def test_missing_segment(self):
+        key, filename, _ = self.make_file(3500)
+        self.store(key, filename)
+        self.server.delete_object(CONTAINER, key + "/segment0001")
+        dst = os.path.join(self.tmp_dir, "dst")
+        reply = self.annex.request("TRANSFER RETRIEVE %s %s" % (key, dst))
+        self.assertReply(reply, "TRANSFER-FAILURE")
+        self.remove(key)
+        self.assertEqual(self.server.objects(CONTAINER), [])
+
+    def test_too_many_segments(self):
+        self.server.slo["max_manifest_segments"] = 2
+        key, filename, md5 = self.make_file(3500)
+        self.store(key, filename)
+        self.assertEqual(len(self.server.get_object(CONTAINER, key).manifest), 2)
+        self.retrieve(key, md5)
+
+    def test_too_small_segments(self):
+        self.server.slo["min_segment_size"] = 2000
+        key, filename, md5 = self.make_file(3500)
+        self.store(key, filename)
+        self.assertEqual(len(self.server.get_object(CONTAINER, key).manifest), 2)
+        self.retrieve(key, md5)
+
+    def test_unsupported(self):
+        self.server.slo = None
+        key, filename, md5 = self.make_file(3500)
+        self.store(key, filename)
+        self.assertIsNone(self.server.get_object(CONTAINER, key).manifest)
+        self.assertIsNotNone(self.server.get_object(CONTAINER, key + "/chunk0003"))
+        self.retrieve(key, md5)
+        self.remove(key)
+        self.assertEqual(self.server.objects(CONTAINER), [])
+
+
+class RemoveTests(FakeHubicTestCase):
+    """Removal with bulk deletes"""
+
+    def test_single_object(self):
+        key, filename, _ = self.make_file(500)
+        self.store(key, filename)
+        self.remove(key)
+        self.assertEqual(self.server.objects(CONTAINER), [])
+        self.check(key, "CHECKPRESENT-FAILURE")
+
+    def test_bulk_delete(self):
+        key, filename, _ = self.make_file(5000)
+        self.store(key, filename)
+        self.server.reset_counts()
+        self.remove(key)
+        self.assertEqual(self.requests().get("POST account"), 1)
+        self.assertEqual(self.server.objects(CONTAINER), [])
+
+    def test_interrupted_removal(self):
+        key, filename, _ = self.make_file(5000)
+        self.store(key, filename)
+        self.server.inject(400, "POST")
+        self.assertReply(self.annex.request("REMOVE " + key), "REMOVE-FAILURE")
+        # Whatever is left, the file must not look present
+        self.check(key, "CHECKPRESENT-FAILURE")
+        self.server.failures.clear()
+        self.remove(key)
+        self.assertEqual(self.server.objects(CONTAINER), [])
+
+
+class IndexTests(FakeHubicTestCase):
+    """Persistent index of the stored keys"""
+    config = {"hubic_persistent_index": "yes"}
+
+    def test_present_with_one_request(self):
+        key, filename, _ = self.make_file(3500)
+        self.store(key, filename)
+        self.server.reset_counts()
+        self.check(key, "CHECKPRESENT-SUCCESS")
+        self.assertEqual(self.requests(), {"HEAD object": 1})
+
+    def test_removed_from_another_repository(self):
+        files = [self.make_file(size) for size in (500, 3500)]
+        for key, filename, _ in files:
+            self.store(key, filename)
+        other = self.start_remote(git_dir=tempfile.mkdtemp(dir=self.tmp_dir))
+        for key, _, _ in files:
+            self.remove(key, other)
+        for key, _, _ in files:
+            self.check(key, "CHECKPRESENT-FAILURE")
+
+    def resync(self, repo):
+        """Run resync-index in repo, with a small listing page size"""
+        cwd = os.getcwd()
+        os.chdir(repo)
+        try:
+            with unittest.mock.patch.object(index, "LISTING_PAGE_SIZE", 2), \
+                 unittest.mock.patch.multiple(auth.HubicAuth,
+                                              access_token_url=self.server.url + "oauth/token",
+                                              base_url=self.server.url + "1.0/"), \
+                 contextlib.redirect_stdout(io.StringIO()), \
+                 contextlib.redirect_stderr(io.StringIO()):
+                resync.main(["hubic", "--token", "fake-refresh-token"])
+        finally:
+            os.chdir(cwd)
+
+    def test_resync_renews_rejected_tokens(self):
+        # A repository where the remote is known to git-annex
+        repo = os.path.join(self.tmp_dir, "repo")
+        subprocess.check_call(["git", "init", "-q", repo])
+        git = functools.partial(subprocess.check_output, cwd=repo, universal_newlines=True)
+        blob = git(["git", "hash-object", "-w", "--stdin"],
+                   input="bench-uuid name=hubic hubic_container=%s timestamp=1s\n" % CONTAINER)
+        tree = git(["git", "mktree"], input="100644 blob %s\tremote.log\n" % blob.strip())
+        commit = git(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                      "commit-tree", "-m", "remote.log", tree.strip()])
+        git(["git", "update-ref", "refs/heads/git-annex", commit.strip()])
+        annex = self.start_remote(git_dir=os.path.join(repo, ".git"))
+
+        # Files stored from another repository are only found after a resync
+        files = [self.make_file(size) for size in (500, 3500, 600)]
+        other = self.start_remote(git_dir=tempfile.mkdtemp(dir=self.tmp_dir))
+        for key, filename, _ in files:
+            self.store(key, filename, other)
+        self.server.inject(401, "GET", "/" + CONTAINER)
+        self.server.reset_counts()
+        self.resync(repo)
+        self.assertEqual(self.requests().get("GET api"), 2)
+        for key, _, _ in files:
+            self.server.reset_counts()
+            self.check(key, "CHECKPRESENT-SUCCESS", annex)
+            self.assertEqual(self.requests(), {"HEAD object": 1})
+
+
+class MigrateTests(FakeHubicTestCase):
+    """Migration out of the default container"""
+    config = {"hubic_container": "default", "hubic_path": "old"}
+
+    def migrate(self, checkpoint):
+        argv = ["git-annex-remote-hubic-migrate", "old", "new", "newp",
+                "--token", "fake-refresh-token", "--checkpoint", checkpoint]
+        with unittest.mock.patch.object(sys, "argv", argv), \
+             unittest.mock.patch.object(index, "LISTING_PAGE_SIZE", 2), \
+             unittest.mock.patch.multiple(auth.HubicAuth,
+                                          access_token_url=self.server.url + "oauth/token",
+                                          base_url=self.server.url + "1.0/"), \
+             contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            try:
+                migrate.main()
+            except SystemExit as exc:
+                return exc.code
+        return 0
+
+    def test_resume_from_checkpoint(self):
+        files = [self.make_file(size) for size in (100, 200, 300, 2500, 400, 500)]
+        for key, filename, _ in files:
+            self.store(key, filename)
+        checkpoint = os.path.join(self.tmp_dir, "checkpoint")
+
+        # Files are processed in the order of the source listing
+        sources = [name.split("/") for name in self.server.objects("default")
+                   if name.startswith("old/") and name.count("/") >= 3]
+        failing = sources[3]
+        self.server.inject(400, "PUT", "/new/newp/" + "/".join(failing[3:]), count=100)
+        self.assertEqual(self.migrate(checkpoint), 1)
+        with open(checkpoint) as saved:
+            marker = json.load(saved)["marker"]
+        self.assertLess(marker, "/".join(failing))
+
+        self.server.failures.clear()
+        self.server.reset_counts()
+        self.assertEqual(self.migrate(checkpoint), 0)
+        self.assertFalse(os.path.exists(checkpoint))
+        # Only the files after the checkpoint were listed and looked at again
+        self.assertLess(self.requests()["PUT object"], len(files))
+
+        annex = self.start_remote(hubic_container="new", hubic_path="newp")
+        for key, _, md5 in files:
+            self.check(key, "CHECKPRESENT-SUCCESS", annex)
+            self.retrieve(key, md5, annex)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+# Copyright (c) 2014-2016 Thomas Jost and the Contributors
+#
+# This file is part of git-annex-remote-hubic.
+#
+# git-annex-remote-hubic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# git-annex-remote-hubic is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# git-annex-remote-hubic. If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the parts of the remote that don't need hubiC"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hubic_remote.remote import hash_dir_mixed, non_chunk_key
+
+
+class DirHashTests(unittest.TestCase):
+    def test_hash_dir_mixed(self):
+        # As computed by git-annex for this key
+        self.assertEqual(hash_dir_mixed("SHA256E-s100--abc"), "Mk/2X/")
+
+    def test_chunks_are_hashed_like_their_key(self):
+        self.assertEqual(hash_dir_mixed("SHA256E-s100-S10-C1--abc"), "Mk/2X/")
+        self.assertEqual(hash_dir_mixed("SHA256E-s100-S10-C10--abc"), "Mk/2X/")
+
+    def test_non_chunk_key(self):
+        self.assertEqual(non_chunk_key("SHA256E-s100-S10-C3--abc.txt"),
+                         "SHA256E-s100--abc.txt")
+        self.assertEqual(non_chunk_key("WORM-s10-m1444--a-S10-C1"),
+                         "WORM-s10-m1444--a-S10-C1")
+        self.assertEqual(non_chunk_key("GPGHMACSHA1--abc"), "GPGHMACSHA1--abc")
+
+
+if __name__ == "__main__":
+    unittest.main()